@@ -12,8 +12,9 @@ from routers import (
     general_utils_route,
     llm_route,
 )
-from utils import email_utils
+from utils import email_utils, langchain_utils, openai_utils
 from utils.config_utils import get_config
+from utils.job_utils import job_queue
 
 dotenv.load_dotenv()
 
@@ -58,6 +59,18 @@ app.include_router(
 @app.on_event("startup")
 async def startup_event():
     asyncio.create_task(email_utils.send_scheduled_emails_loop())
+    langchain_utils.start_write_behind()
+
+
+@app.on_event("shutdown")
+def shutdown_event():
+    job_queue.shutdown()
+    langchain_utils.stop_write_behind()
+
+
+@app.on_event("shutdown")
+async def close_sessions_event():
+    await openai_utils.close_aiohttp_session()
 
 
 @app.get("/")
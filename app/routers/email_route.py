@@ -4,6 +4,7 @@ from typing import Optional
 from db import db_helper
 from depends.auth_dep import verify_credentials
 from fastapi import APIRouter, Depends
+from fastapi.responses import StreamingResponse
 from google.oauth2.credentials import Credentials
 from pydantic import BaseModel
 from schemas.response import APIResponse
@@ -11,6 +12,8 @@ from utils import email_utils, langchain_utils
 from utils.config_utils import get_config
 from utils.email_utils import HistoryMessage
 from utils.googleapi_utils import fetch_gmail_messages
+from utils.job_utils import Job, job_queue
+from utils.stream_utils import iter_sse
 
 router = APIRouter()
 
@@ -43,16 +46,37 @@ def get_gpt_revision(
 def query_email_thread(
     thread_id: str,
     q: str,
+    stream: bool = False,
+    no_cache: bool = False,
 ):
-    if not langchain_utils.check_vectorstore_exists(thread_id):
-        return {
-            "error": True,
-            "message": "index does not exists",
-        }
-
-    index = langchain_utils.load_vectorstore(path=thread_id)
+    with langchain_utils.read_lock(thread_id):
+        if not langchain_utils.check_vectorstore_exists(thread_id):
+            return {
+                "error": True,
+                "message": "index does not exists",
+            }
 
-    result = langchain_utils.query_vectorstore(index, q)
+        index = langchain_utils.load_vectorstore(path=thread_id)
+        langchain_utils.record_vectorstore_query(thread_id)
+
+    # both lock the collection during the retrieval only
+    if stream:
+        events = langchain_utils.stream_query_vectorstore(
+            index,
+            q,
+            collection_id=thread_id,
+        )
+        return StreamingResponse(
+            iter_sse(events),
+            media_type="text/event-stream",
+        )
+
+    result = langchain_utils.query_vectorstore(
+        index,
+        q,
+        collection_id=thread_id,
+        no_cache=no_cache,
+    )
     return {
         "data": result,
     }
@@ -125,6 +149,8 @@ def schedule_email(
 class IndexThreadBody(BaseModel):
     thread_id: str
     messages: list[str]
+    # return a job id right away, see GET /llm/jobs/{job_id}
+    background: bool = False
 
 
 @router.post("/index_thread", response_model=APIResponse)
@@ -138,10 +164,35 @@ def index_email_thread(
         }
 
     docs = langchain_utils.txts2docs(body.messages)
-    langchain_utils.create_vectorstore_index(docs, path=body.thread_id)
+    progress = langchain_utils.IngestProgress()
+
+    def run(job: Job = None) -> dict:
+        # another job may have created it while this one was queued
+        if job and langchain_utils.check_vectorstore_exists(body.thread_id):
+            raise ValueError("index already exists")
+
+        langchain_utils.create_vectorstore_index(
+            docs,
+            path=body.thread_id,
+            progress=progress,
+        )
+        return progress.dict()
+
+    if body.background:
+        job = job_queue.submit(
+            "index_thread",
+            body.thread_id,
+            run,
+            payload=body.messages,
+            progress=progress,
+        )
+        return {
+            "data": job.dict(),
+        }
 
     return {
         "error": False,
+        "data": run(),
     }
 
 
@@ -156,11 +207,31 @@ def add_messages_to_thread(
         }
 
     docs = langchain_utils.txts2docs(body.messages)
-    index = langchain_utils.load_vectorstore(path=body.thread_id)
-    langchain_utils.add_docs_to_vectorstore(docs, index)
+    progress = langchain_utils.IngestProgress()
+
+    def run(job: Job = None) -> dict:
+        langchain_utils.add_docs_to_vectorstore(
+            docs,
+            path=body.thread_id,
+            progress=progress,
+        )
+        return progress.dict()
+
+    if body.background:
+        job = job_queue.submit(
+            "add_messages",
+            body.thread_id,
+            run,
+            payload=body.messages,
+            progress=progress,
+        )
+        return {
+            "data": job.dict(),
+        }
 
     return {
         "error": False,
+        "data": run(),
     }
 
 
@@ -175,10 +246,35 @@ def update_index_email_thread(
         }
 
     docs = langchain_utils.txts2docs(body.messages)
-    langchain_utils.create_vectorstore_index(docs, path=body.thread_id)
 
+    def run(job: Job = None) -> dict:
+        return langchain_utils.update_vectorstore_index(
+            docs,
+            path=body.thread_id,
+        )
+
+    if body.background:
+        job = job_queue.submit(
+            "update_thread",
+            body.thread_id,
+            run,
+            payload=body.messages,
+        )
+        return {
+            "data": job.dict(),
+        }
+
+    try:
+        data = run()
+    except ValueError as err:
+        # the thread was deleted since the check above
+        return {
+            "error": True,
+            "message": str(err),
+        }
     return {
         "error": False,
+        "data": data,
     }
 
 
@@ -208,6 +304,7 @@ class FollowUpEmailBody(BaseModel):
     history: list[HistoryMessage]
     user_input: str
     instruction: Optional[str] = None
+    no_cache: bool = False
 
 
 @router.post("/follow_up", response_model=APIResponse)
@@ -218,6 +315,7 @@ def follow_up_email(
         history=body.history,
         user_input=body.user_input,
         instruction=body.instruction,
+        no_cache=body.no_cache,
     )
     return {
         "data": result,
@@ -1,28 +1,68 @@
+import asyncio
+from queue import Queue
 from typing import Optional
 
 from db import db_helper
-from fastapi import APIRouter
+from fastapi import APIRouter, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from schemas.response import APIResponse
 from utils import langchain_utils
-from utils.llama_utils import run_chatgpt
+from utils.config_utils import get_config
+from utils.job_utils import Job, job_queue
+from utils.llama_utils import (
+    run_chatgpt,
+    run_chatgpt_batch,
+    stream_chatgpt,
+    stream_chatgpt_batch,
+)
+from utils.llm_cache_utils import get_semantic_cache_stats
+from utils.openai_utils import get_rate_limit_stats
+from utils.stream_utils import (
+    aiter_sse,
+    feed_queue,
+    iter_lines,
+    iter_queue,
+    iter_sse,
+)
 
 router = APIRouter()
 
 client = db_helper.get_client()
 
+config = get_config()
+
 
 class RunChatGPTBody(BaseModel):
     prompt: str
     instruction: Optional[str] = None
+    no_cache: bool = False
+    # send the answer as server-sent events, see `stream_chatgpt`
+    stream: bool = False
 
 
 @router.post("/chatgpt", response_model=APIResponse)
-def run_chatgpt_route(
+async def run_chatgpt_route(
     body: RunChatGPTBody,
 ):
+    if body.stream:
+        events = stream_chatgpt(
+            body.prompt,
+            body.instruction,
+            no_cache=body.no_cache,
+        )
+        return StreamingResponse(
+            aiter_sse(events),
+            media_type="text/event-stream",
+        )
+
     try:
-        res = run_chatgpt(body.prompt, body.instruction)
+        res = await run_chatgpt(
+            body.prompt,
+            body.instruction,
+            no_cache=body.no_cache,
+        )
         return {
             "data": res,
         }
@@ -33,20 +73,169 @@ def run_chatgpt_route(
         }
 
 
-@router.get("/index_collection/{collection_id}", response_model=APIResponse)
-def query_email_thread(
+class ChatGPTBatchItem(BaseModel):
+    prompt: str
+    instruction: Optional[str] = None
+
+
+class RunChatGPTBatchBody(BaseModel):
+    items: list[ChatGPTBatchItem]
+    no_cache: bool = False
+    # completions in flight, capped by llm.batch.max_concurrency
+    max_concurrency: Optional[int] = None
+    # send each result as a server-sent event once it completes
+    stream: bool = False
+
+
+@router.post("/chatgpt/batch", response_model=APIResponse)
+async def run_chatgpt_batch_route(
+    body: RunChatGPTBatchBody,
+):
+    if len(body.items) > config.llm.batch.max_items:
+        return {
+            "error": True,
+            "message": "too many items, the maximum is %d"
+            % config.llm.batch.max_items,
+        }
+
+    items = [(item.prompt, item.instruction) for item in body.items]
+    if body.stream:
+        events = stream_chatgpt_batch(
+            items,
+            no_cache=body.no_cache,
+            max_concurrency=body.max_concurrency,
+        )
+        return StreamingResponse(
+            aiter_sse(events),
+            media_type="text/event-stream",
+        )
+
+    res = await run_chatgpt_batch(
+        items,
+        no_cache=body.no_cache,
+        max_concurrency=body.max_concurrency,
+    )
+    return {
+        "data": res,
+    }
+
+
+@router.get("/stats", response_model=APIResponse)
+def get_stats():
+    return {
+        "data": {
+            "vectorstore_cache": langchain_utils.get_vectorstore_cache_stats(),
+            "embedding_cache": langchain_utils.get_embedding_cache_stats(),
+            "semantic_cache": get_semantic_cache_stats(),
+            "write_behind": langchain_utils.get_write_behind_stats(),
+            "jobs": job_queue.stats(),
+            "collections": langchain_utils.get_vectorstore_registry_stats(),
+            "locks": langchain_utils.get_lock_stats(),
+            "rate_limits": get_rate_limit_stats(),
+        },
+    }
+
+
+@router.get("/index_collection", response_model=APIResponse)
+def list_collections(
+    offset: int = 0,
+    limit: int = 100,
+):
+    collections = langchain_utils.list_vectorstore_info(offset, limit)
+    return {
+        "data": collections,
+    }
+
+
+@router.get(
+    "/index_collection/{collection_id}/info",
+    response_model=APIResponse,
+)
+def get_collection_info(
     collection_id: str,
-    q: str,
 ):
-    if not langchain_utils.check_vectorstore_exists(collection_id):
+    info = langchain_utils.get_vectorstore_info(collection_id)
+    if info is None:
         return {
             "error": True,
             "message": "index does not exists",
         }
 
-    index = langchain_utils.load_vectorstore(path=collection_id)
+    return {
+        "data": info,
+    }
+
+
+@router.get("/index_collection/{collection_id}", response_model=APIResponse)
+def query_email_thread(
+    collection_id: str,
+    q: str,
+    stream: bool = False,
+    no_cache: bool = False,
+):
+    with langchain_utils.read_lock(collection_id):
+        if not langchain_utils.check_vectorstore_exists(collection_id):
+            return {
+                "error": True,
+                "message": "index does not exists",
+            }
+
+        index = langchain_utils.load_vectorstore(path=collection_id)
+        langchain_utils.record_vectorstore_query(collection_id)
+
+    # both lock the collection during the retrieval only
+    if stream:
+        events = langchain_utils.stream_query_vectorstore(
+            index,
+            q,
+            collection_id=collection_id,
+        )
+        return StreamingResponse(
+            iter_sse(events),
+            media_type="text/event-stream",
+        )
+
+    result = langchain_utils.query_vectorstore(
+        index,
+        q,
+        collection_id=collection_id,
+        no_cache=no_cache,
+    )
+    return {
+        "data": result,
+    }
+
+
+@router.get(
+    "/index_collection/{collection_id}/search",
+    response_model=APIResponse,
+)
+def search_collection(
+    collection_id: str,
+    q: str,
+    k: int = 4,
+    mmr: bool = False,
+    fetch_k: int = 20,
+    lambda_mult: float = 0.5,
+):
+    with langchain_utils.read_lock(collection_id):
+        if not langchain_utils.check_vectorstore_exists(collection_id):
+            return {
+                "error": True,
+                "message": "index does not exists",
+            }
+
+        index = langchain_utils.load_vectorstore(path=collection_id)
+        langchain_utils.record_vectorstore_query(collection_id)
 
-    result = langchain_utils.query_vectorstore(index, q)
+        result = langchain_utils.search_vectorstore(
+            index,
+            q,
+            k=k,
+            mmr=mmr,
+            fetch_k=fetch_k,
+            lambda_mult=lambda_mult,
+        )
     return {
         "data": result,
     }
@@ -73,6 +262,8 @@ def index_documents(
 class IndexCollectionBody(BaseModel):
     collection_id: str
     documents: list[str]
+    # return a job id right away, see GET /llm/jobs/{job_id}
+    background: bool = False
 
 
 @router.post("/index_collection", response_model=APIResponse)
@@ -86,10 +277,37 @@ def index_collection(
         }
 
     docs = langchain_utils.txts2docs(body.documents)
-    langchain_utils.create_vectorstore_index(docs, path=body.collection_id)
+    progress = langchain_utils.IngestProgress()
+
+    def run(job: Job = None) -> dict:
+        # another job may have created it while this one was queued
+        if job and langchain_utils.check_vectorstore_exists(
+            body.collection_id
+        ):
+            raise ValueError("index already exists")
+
+        langchain_utils.create_vectorstore_index(
+            docs,
+            path=body.collection_id,
+            progress=progress,
+        )
+        return progress.dict()
+
+    if body.background:
+        job = job_queue.submit(
+            "index_collection",
+            body.collection_id,
+            run,
+            payload=body.documents,
+            progress=progress,
+        )
+        return {
+            "data": job.dict(),
+        }
 
     return {
         "error": False,
+        "data": run(),
     }
 
 
@@ -104,11 +322,109 @@ def add_document_to_collection(
         }
 
     docs = langchain_utils.txts2docs(body.documents)
-    index = langchain_utils.load_vectorstore(path=body.collection_id)
-    index = langchain_utils.add_docs_to_vectorstore(docs=docs, db=index)
+    progress = langchain_utils.IngestProgress()
+
+    def run(job: Job = None) -> dict:
+        langchain_utils.add_docs_to_vectorstore(
+            docs=docs,
+            path=body.collection_id,
+            progress=progress,
+        )
+        return progress.dict()
+
+    if body.background:
+        job = job_queue.submit(
+            "add_documents",
+            body.collection_id,
+            run,
+            payload=body.documents,
+            progress=progress,
+        )
+        return {
+            "data": job.dict(),
+        }
+
+    return {
+        "error": False,
+        "data": run(),
+    }
+
+
+@router.post(
+    "/index_collection/{collection_id}/stream",
+    response_model=APIResponse,
+)
+async def stream_index_collection(
+    collection_id: str,
+    request: Request,
+):
+    """Index an NDJSON body as it is uploaded, creating the collection if
+    it does not exist. See `langchain_utils.ndjson2docs` for the format"""
+    lines = Queue(maxsize=config.llm.langchain.ingest.stream_queue_size)
+    progress = langchain_utils.IngestProgress()
+
+    def ingest() -> None:
+        docs = langchain_utils.ndjson2docs(iter_queue(lines))
+        with langchain_utils.write_lock(collection_id):
+            if langchain_utils.check_vectorstore_exists(collection_id):
+                langchain_utils.add_docs_to_vectorstore(
+                    docs,
+                    path=collection_id,
+                    progress=progress,
+                )
+            else:
+                langchain_utils.create_vectorstore_index(
+                    docs,
+                    path=collection_id,
+                    progress=progress,
+                )
+
+    consumer = asyncio.ensure_future(run_in_threadpool(ingest))
+    await feed_queue(iter_lines(request.stream()), lines, consumer)
+    try:
+        await consumer
+    except Exception as e:
+        return {
+            "error": True,
+            "message": str(e),
+            "data": progress.dict(),
+        }
 
     return {
         "error": False,
+        "data": progress.dict(),
+    }
+
+
+@router.get("/jobs/{job_id}", response_model=APIResponse)
+def get_job(
+    job_id: str,
+):
+    job = job_queue.get(job_id)
+    if job is None:
+        return {
+            "error": True,
+            "message": "job does not exists",
+        }
+
+    return {
+        "data": job.dict(),
+    }
+
+
+@router.post("/flush", response_model=APIResponse)
+def flush_collections(
+    collection_id: Optional[str] = None,
+):
+    if collection_id:
+        flushed = int(langchain_utils.flush_vectorstore(collection_id))
+    else:
+        flushed = langchain_utils.flush_vectorstores()
+
+    return {
+        "data": {
+            "flushed": flushed,
+        },
     }
 
 
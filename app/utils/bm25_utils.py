@@ -0,0 +1,204 @@
+import heapq
+import math
+import re
+import sqlite3
+import threading
+from collections import Counter
+from pathlib import Path
+from typing import Hashable, Iterable
+
+from utils.sqlite_utils import in_batches
+
+# words, and identifiers like order numbers, dates or e-mail addresses kept
+# whole on top of their parts
+_WORD = re.compile(r"\w+")
+_IDENTIFIER = re.compile(r"\w+(?:[-./@:]\w+)+")
+
+
+def tokenize(text: str) -> list[str]:
+    text = text.lower()
+    return _WORD.findall(text) + _IDENTIFIER.findall(text)
+
+
+def reciprocal_rank_fusion(
+    rankings: Iterable[list[Hashable]],
+    k: int = 60,
+) -> list[tuple[Hashable, float]]:
+    """Merge rankings by summing 1 / (k + rank) of every item
+
+    Only ranks are used, so rankings with scores on different scales
+    (cosine similarity, BM25) are merged fairly.
+
+    Returns:
+        list[tuple[Hashable, float]]: items and fused scores, best first
+    """
+    scores: dict[Hashable, float] = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + 1 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class BM25Index:
+    """Inverted index of the chunks of a collection, scored with BM25
+
+    Kept in a SQLite file in the collection directory and updated with the
+    chunks added to or deleted from the vectorstore, so a query reads the
+    postings of its terms only.
+
+    Args:
+        path (str | Path): directory of the collection
+        readonly (bool, optional): open an existing index for searches
+        only, without setting up its schema. Defaults to False.
+    """
+
+    FILE = "bm25.sqlite3"
+
+    # term frequency saturation and document length normalization
+    K1 = 1.5
+    B = 0.75
+
+    def __init__(self, path: str | Path, readonly: bool = False) -> None:
+        path = Path(path)
+        self._lock = threading.Lock()
+        if readonly:
+            self._conn = sqlite3.connect(
+                "%s?mode=ro" % (path / self.FILE).resolve().as_uri(),
+                uri=True,
+                check_same_thread=False,
+            )
+            return
+
+        path.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(
+            str(path / self.FILE),
+            check_same_thread=False,
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS chunks (
+                id TEXT PRIMARY KEY,
+                length INTEGER NOT NULL
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS postings (
+                term TEXT NOT NULL,
+                chunk_id TEXT NOT NULL,
+                tf INTEGER NOT NULL,
+                PRIMARY KEY (term, chunk_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS postings_chunk
+                ON postings (chunk_id);
+            CREATE TABLE IF NOT EXISTS totals (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                chunks INTEGER NOT NULL,
+                length INTEGER NOT NULL
+            );
+            INSERT OR IGNORE INTO totals VALUES (0, 0, 0);
+            """
+        )
+        self._conn.commit()
+
+    @classmethod
+    def exists(cls, path: str | Path) -> bool:
+        return (Path(path) / cls.FILE).exists()
+
+    def add(self, ids: Iterable[str], texts: Iterable[str]) -> None:
+        chunks, postings = [], []
+        for chunk_id, text in zip(ids, texts):
+            terms = tokenize(text)
+            chunks.append((chunk_id, len(terms)))
+            postings.extend(
+                (term, chunk_id, tf) for term, tf in Counter(terms).items()
+            )
+
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO chunks (id, length) VALUES (?, ?)", chunks
+            )
+            self._conn.executemany(
+                "INSERT INTO postings (term, chunk_id, tf) VALUES (?, ?, ?)",
+                postings,
+            )
+            self._update_totals(
+                len(chunks), sum(length for _, length in chunks)
+            )
+
+    def remove(self, ids: Iterable[str]) -> None:
+        ids = list(ids)
+        with self._lock, self._conn:
+            removed, length = 0, 0
+            for batch, placeholders in in_batches(ids):
+                row = self._conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(length), 0) FROM chunks "
+                    f"WHERE id IN ({placeholders})",
+                    batch,
+                ).fetchone()
+                removed += row[0]
+                length += row[1]
+                self._conn.execute(
+                    f"DELETE FROM postings WHERE chunk_id IN ({placeholders})",
+                    batch,
+                )
+                self._conn.execute(
+                    f"DELETE FROM chunks WHERE id IN ({placeholders})",
+                    batch,
+                )
+            self._update_totals(-removed, -length)
+
+    def _update_totals(self, chunks: int, length: int) -> None:
+        # kept up to date so queries don't scan the chunks
+        self._conn.execute(
+            "UPDATE totals SET chunks = chunks + ?, length = length + ?",
+            (chunks, length),
+        )
+
+    def ids(self) -> set[str]:
+        with self._lock:
+            rows = self._conn.execute("SELECT id FROM chunks")
+            return {row[0] for row in rows}
+
+    def count(self) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT chunks FROM totals").fetchone()
+        return row[0]
+
+    def search(self, query: str, k: int) -> list[tuple[str, float]]:
+        """Chunks matching the terms of a query
+
+        Returns:
+            list[tuple[str, float]]: chunk ids and BM25 scores, best first
+        """
+        terms = list(set(tokenize(query)))
+        if not terms or k <= 0:
+            return []
+
+        placeholders = ",".join("?" * len(terms))
+        with self._lock:
+            n, total_length = self._conn.execute(
+                "SELECT chunks, length FROM totals"
+            ).fetchone()
+            rows = self._conn.execute(
+                "SELECT p.term, p.chunk_id, p.tf, c.length "
+                "FROM postings p JOIN chunks c ON c.id = p.chunk_id "
+                f"WHERE p.term IN ({placeholders})",
+                terms,
+            ).fetchall()
+        if not n:
+            return []
+
+        df = Counter(term for term, *_ in rows)
+        avg_length = total_length / n or 1.0
+        scores: dict[str, float] = {}
+        for term, chunk_id, tf, length in rows:
+            idf = math.log(1 + (n - df[term] + 0.5) / (df[term] + 0.5))
+            norm = self.K1 * (1 - self.B + self.B * length / avg_length)
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * (
+                tf * (self.K1 + 1) / (tf + norm)
+            )
+
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
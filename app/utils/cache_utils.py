@@ -0,0 +1,207 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+SizeFunc = Callable[[Hashable, Any], int]
+EvictFunc = Callable[[Hashable, Any], None]
+
+
+class LRUCache:
+    """Thread-safe LRU cache bounded by item count and approximate size.
+
+    Args:
+        max_items (int, optional): maximum number of cached items.
+        Defaults to 32.
+
+        max_bytes (int, optional): maximum total size of cached items as
+        reported by `sizeof`. Defaults to None (no size budget).
+
+        sizeof (SizeFunc, optional): function returning the approximate
+        size in bytes of a (key, value) pair. Defaults to None.
+
+        on_evict (EvictFunc, optional): callback called with (key, value)
+        for every item evicted or invalidated. It is called outside of the
+        cache lock. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        max_items: int = 32,
+        max_bytes: int = None,
+        sizeof: SizeFunc = None,
+        on_evict: EvictFunc = None,
+    ) -> None:
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._on_evict = on_evict
+
+        self._items: OrderedDict[Hashable, Any] = OrderedDict()
+        self._sizes: dict[Hashable, int] = {}
+        self._total_bytes = 0
+        self._lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._items
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._items)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            if key not in self._items:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """Insert or refresh an item, then evict until within budget"""
+        with self._lock:
+            self._remove(key)
+
+            size = self._sizeof(key, value) if self._sizeof else 0
+            self._items[key] = value
+            self._sizes[key] = size
+            self._total_bytes += size
+
+            evicted = self._evict_over_budget()
+
+        self._notify(evicted)
+
+    def resize(self, key: Hashable) -> None:
+        """Re-measure an item whose size changed in place"""
+        with self._lock:
+            if key not in self._items:
+                return
+            value = self._items[key]
+
+        # measuring may be slow (e.g. stat-ing files), keep it unlocked
+        size = self._sizeof(key, value) if self._sizeof else 0
+
+        with self._lock:
+            if self._items.get(key) is not value:
+                return
+            self._total_bytes += size - self._sizes[key]
+            self._sizes[key] = size
+            evicted = self._evict_over_budget()
+
+        self._notify(evicted)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Remove an item without calling the eviction callback"""
+        with self._lock:
+            if key not in self._items:
+                return default
+            return self._remove(key)
+
+    def invalidate(self, key: Hashable) -> bool:
+        """Remove an item and call the eviction callback on it
+
+        Returns:
+            bool: True if the key was cached
+        """
+        with self._lock:
+            if key not in self._items:
+                return False
+            value = self._remove(key)
+
+        self._notify([(key, value)])
+        return True
+
+    def clear(self) -> None:
+        with self._lock:
+            evicted = list(self._items.items())
+            self._items.clear()
+            self._sizes.clear()
+            self._total_bytes = 0
+
+        self._notify(evicted)
+
+    def sizes(self) -> list[tuple[Hashable, int]]:
+        """Keys and sizes of the cached items, least recently used first"""
+        with self._lock:
+            return [(key, self._sizes[key]) for key in self._items]
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "items": len(self._items),
+                "max_items": self.max_items,
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "evicted_bytes": self.evicted_bytes,
+            }
+
+    def _remove(self, key: Hashable) -> Any:
+        if key not in self._items:
+            return None
+        self._total_bytes -= self._sizes.pop(key)
+        return self._items.pop(key)
+
+    def _over_budget(self) -> bool:
+        if self.max_items is not None and len(self._items) > self.max_items:
+            return True
+        if self.max_bytes is not None and self._total_bytes > self.max_bytes:
+            return True
+        return False
+
+    def _evict_over_budget(self) -> list[tuple[Hashable, Any]]:
+        evicted = []
+        # always keep the most recently used item, even if it alone is
+        # bigger than the budget
+        while len(self._items) > 1 and self._over_budget():
+            key = next(iter(self._items))
+            self.evicted_bytes += self._sizes[key]
+            evicted.append((key, self._remove(key)))
+            self.evictions += 1
+        return evicted
+
+    def _notify(self, evicted: list[tuple[Hashable, Any]]) -> None:
+        if not self._on_evict:
+            return
+        for key, value in evicted:
+            self._on_evict(key, value)
+
+
+class ObjectRegistry:
+    """Thread-safe registry that builds shared objects once per key
+
+    Meant for objects that are expensive to set up and safe to share
+    across threads, such as LLM clients and chains.
+    """
+
+    def __init__(self) -> None:
+        self._objects: dict[Hashable, Any] = {}
+        # reentrant, factories may get other objects from the registry
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._objects)
+
+    def get_or_create(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        with self._lock:
+            if key not in self._objects:
+                self._objects[key] = factory()
+            return self._objects[key]
+
+    def items(self) -> list[tuple[Hashable, Any]]:
+        with self._lock:
+            return list(self._objects.items())
+
+    def clear(self) -> None:
+        with self._lock:
+            self._objects.clear()
@@ -0,0 +1,221 @@
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Iterable
+
+from utils.sqlite_utils import in_batches
+
+DOCUMENT = "document"
+CHUNK = "chunk"
+
+
+class ContentHashSet:
+    """Content hashes of the documents and chunks stored in a collection
+
+    Kept in a SQLite file in the collection directory, so it is removed
+    with the collection and lookups don't need the vectorstore.
+
+    Args:
+        path (str | Path): directory of the collection
+    """
+
+    FILE = "hashes.sqlite3"
+
+    def __init__(self, path: str | Path) -> None:
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            str(path / self.FILE),
+            check_same_thread=False,
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # True for a new set, or one created before chunks were tracked by
+        # document, the caller fills it from the vectorstore
+        self.created = not self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'refs'"
+        ).fetchone()
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS hashes (
+                kind TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                PRIMARY KEY (kind, hash)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS refs (
+                chunk TEXT NOT NULL,
+                document TEXT NOT NULL,
+                PRIMARY KEY (chunk, document)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS refs_document ON refs (document);
+            """
+        )
+        self._conn.commit()
+
+    @classmethod
+    def exists(cls, path: str | Path) -> bool:
+        return (Path(path) / cls.FILE).exists()
+
+    def contains(self, kind: str, hashes: Iterable[str]) -> set[str]:
+        """Subset of `hashes` already in the set"""
+        hashes = list(hashes)
+        found = set()
+        with self._lock:
+            for batch, placeholders in in_batches(hashes):
+                rows = self._conn.execute(
+                    "SELECT hash FROM hashes "
+                    f"WHERE kind = ? AND hash IN ({placeholders})",
+                    [kind, *batch],
+                )
+                found.update(row[0] for row in rows)
+        return found
+
+    def add(self, kind: str, hashes: Iterable[str]) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO hashes (kind, hash) VALUES (?, ?)",
+                ((kind, h) for h in hashes),
+            )
+
+    def remove(self, kind: str, hashes: Iterable[str]) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "DELETE FROM hashes WHERE kind = ? AND hash = ?",
+                ((kind, h) for h in hashes),
+            )
+
+    def members(self, kind: str) -> set[str]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT hash FROM hashes WHERE kind = ?", (kind,)
+            )
+            return {row[0] for row in rows}
+
+    def add_refs(self, refs: Iterable[tuple[str, str]]) -> None:
+        """Record that documents contain chunks, as (chunk, document)
+        hash pairs. A chunk shared by several documents is stored once"""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO refs (chunk, document) VALUES (?, ?)",
+                refs,
+            )
+
+    def remove_documents(
+        self,
+        documents: Iterable[str],
+        chunks: Iterable[str] = (),
+    ) -> set[str]:
+        """Remove documents, and the chunks no other document contains
+
+        Args:
+            documents (Iterable[str]): hashes of the documents
+            chunks (Iterable[str], optional): hashes of chunks stored with
+            the documents but possibly not recorded by `add_refs`.
+            Defaults to ().
+
+        Returns:
+            set[str]: hashes of the removed chunks, the caller deletes them
+            from the vectorstore
+        """
+        documents = list(documents)
+        candidates = set(chunks)
+        with self._lock, self._conn:
+            for batch, placeholders in in_batches(documents):
+                rows = self._conn.execute(
+                    "SELECT chunk FROM refs "
+                    f"WHERE document IN ({placeholders})",
+                    batch,
+                )
+                candidates.update(row[0] for row in rows)
+                self._conn.execute(
+                    f"DELETE FROM refs WHERE document IN ({placeholders})",
+                    batch,
+                )
+                self._conn.execute(
+                    "DELETE FROM hashes "
+                    f"WHERE kind = ? AND hash IN ({placeholders})",
+                    [DOCUMENT, *batch],
+                )
+
+            referenced = set()
+            for batch, placeholders in in_batches(candidates):
+                rows = self._conn.execute(
+                    "SELECT DISTINCT chunk FROM refs "
+                    f"WHERE chunk IN ({placeholders})",
+                    batch,
+                )
+                referenced.update(row[0] for row in rows)
+
+            orphans = candidates - referenced
+            self._conn.executemany(
+                "DELETE FROM hashes WHERE kind = ? AND hash = ?",
+                ((CHUNK, h) for h in orphans),
+            )
+        return orphans
+
+    def reconcile(
+        self,
+        chunks: Iterable[str],
+        refs: Iterable[tuple[str, str]],
+    ) -> None:
+        """Match the set to the chunks of a vectorstore whose last writes
+        were lost
+
+        Chunks missing from the store are removed, with the documents
+        containing them so that they can be added again, and stored ones
+        are added back.
+
+        Args:
+            chunks (Iterable[str]): hashes of the stored chunks
+            refs (Iterable[tuple[str, str]]): (chunk, document) hashes
+            of the stored chunks, from their metadata
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TEMP TABLE stored (hash TEXT PRIMARY KEY) WITHOUT ROWID"
+            )
+            try:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO stored (hash) VALUES (?)",
+                    ((h,) for h in chunks),
+                )
+                # documents containing a lost chunk
+                lost = """
+                    SELECT document FROM refs
+                    WHERE chunk NOT IN (SELECT hash FROM stored)
+                """
+                self._conn.execute(
+                    f"DELETE FROM hashes WHERE kind = ? AND hash IN ({lost})",
+                    (DOCUMENT,),
+                )
+                self._conn.execute(
+                    f"DELETE FROM refs WHERE document IN ({lost})"
+                )
+                self._conn.execute(
+                    "DELETE FROM hashes WHERE kind = ? "
+                    "AND hash NOT IN (SELECT hash FROM stored)",
+                    (CHUNK,),
+                )
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO hashes (kind, hash) "
+                    "SELECT ?, hash FROM stored",
+                    (CHUNK,),
+                )
+            finally:
+                self._conn.execute("DROP TABLE stored")
+
+        refs = set(refs)
+        self.add(DOCUMENT, {document for _, document in refs})
+        self.add_refs(refs)
+
+    def count(self, kind: str) -> int:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*) FROM hashes WHERE kind = ?", (kind,)
+            ).fetchone()
+        return row[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
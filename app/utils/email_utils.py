@@ -1,4 +1,5 @@
 import asyncio
+import json
 import smtplib
 from datetime import datetime
 from email.message import EmailMessage
@@ -8,7 +9,10 @@ from db import db_helper
 from langchain import LLMChain, OpenAI, PromptTemplate
 from langchain.memory import ConversationBufferWindowMemory
 from utils.config_utils import get_config
+from utils.embedding_utils import text_hash
+from utils.llm_cache_utils import cached_completion
 from utils.logger_utils import get_logger
+from utils.openai_utils import rate_limited
 
 logger = get_logger()
 
@@ -164,6 +168,7 @@ def write_follow_up_email(
     user_input: str,
     history: list[HistoryMessage],
     instruction: str = None,
+    no_cache: bool = False,
 ) -> str:
     if not instruction:
         instruction = """Assitant is working at an AI company that mainly focus on computer vision.
@@ -203,13 +208,24 @@ def write_follow_up_email(
             memory.chat_memory.add_ai_message(m)
 
     chatgpt_chain = LLMChain(
-        llm=OpenAI(temperature=0.1),
+        llm=rate_limited(OpenAI(temperature=0.1)),
         prompt=prompt,
         verbose=True,
         memory=memory,
     )
 
-    output = chatgpt_chain.predict(
-        human_input=user_input,
+    def complete() -> str:
+        return chatgpt_chain.predict(
+            human_input=user_input,
+        )
+
+    # only the latest input is compared for similarity, the instruction
+    # and history must match exactly
+    context = json.dumps([instruction, history])
+    output = cached_completion(
+        "follow_up:%s" % text_hash(context),
+        user_input,
+        complete,
+        bypass=no_cache,
     )
     return output
@@ -0,0 +1,306 @@
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+from langchain.embeddings import OpenAIEmbeddings
+from langchain.embeddings.base import Embeddings
+from utils.logger_utils import get_logger
+from utils.openai_utils import rate_limited
+from utils.sqlite_utils import in_batches
+
+logger = get_logger()
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Persistent embedding store keyed by (model, sha256 of text)
+
+    Vectors are stored as float32 blobs in a local SQLite file so they
+    survive restarts and are shared by every indexing path.
+
+    Args:
+        path (str | Path): path to the SQLite file
+    """
+
+    def __init__(self, path: str | Path) -> None:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                PRIMARY KEY (model, hash)
+            )
+            """
+        )
+        self._conn.commit()
+
+        self.hits = 0
+        self.misses = 0
+        self.api_calls = 0
+        self.api_seconds = 0.0
+
+    def get_many(
+        self,
+        model: str,
+        hashes: list[str],
+    ) -> dict[str, list[float]]:
+        if not hashes:
+            return {}
+
+        found = {}
+        with self._lock:
+            for batch, placeholders in in_batches(hashes):
+                rows = self._conn.execute(
+                    "SELECT hash, vector FROM embeddings "
+                    f"WHERE model = ? AND hash IN ({placeholders})",
+                    [model, *batch],
+                )
+                for h, blob in rows:
+                    found[h] = np.frombuffer(blob, dtype=np.float32).tolist()
+        return found
+
+    def put_many(
+        self,
+        model: str,
+        items: dict[str, list[float]],
+    ) -> None:
+        rows = [
+            (model, h, np.asarray(v, dtype=np.float32).tobytes())
+            for h, v in items.items()
+        ]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, hash, vector) "
+                "VALUES (?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+
+    def record(self, hits: int, misses: int, seconds: float = 0.0) -> None:
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+            if misses:
+                self.api_calls += 1
+                self.api_seconds += seconds
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            seconds_per_text = (
+                self.api_seconds / self.misses if self.misses else 0.0
+            )
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "api_calls": self.api_calls,
+                "api_seconds": round(self.api_seconds, 3),
+                # what the hits would have cost at the observed API speed
+                "saved_seconds_estimate": round(
+                    self.hits * seconds_per_text, 3
+                ),
+            }
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that reuses vectors from an EmbeddingCache
+
+    Only texts missing from the cache are sent to the wrapped embeddings.
+    Queries are not cached, they are rarely repeated verbatim.
+
+    Args:
+        embeddings (Embeddings): underlying embeddings
+        cache (EmbeddingCache): cache store
+        model (str): model name used in the cache key
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        cache: EmbeddingCache,
+        model: str,
+    ) -> None:
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model = model
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        hashes = [text_hash(text) for text in texts]
+        found = self.cache.get_many(self.model, hashes)
+
+        missing: dict[str, str] = {}
+        for h, text in zip(hashes, texts):
+            if h not in found and h not in missing:
+                missing[h] = text
+
+        seconds = 0.0
+        if missing:
+            start = time.perf_counter()
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            seconds = time.perf_counter() - start
+
+            computed = dict(zip(missing.keys(), vectors))
+            self.cache.put_many(self.model, computed)
+            found.update(computed)
+
+        self.cache.record(
+            hits=len(texts) - len(missing),
+            misses=len(missing),
+            seconds=seconds,
+        )
+        logger.info(
+            "Embedded %d texts, %d from cache"
+            % (len(texts), len(texts) - len(missing))
+        )
+        return [found[h] for h in hashes]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embeddings.embed_query(text)
+
+
+class HashingEmbeddings(Embeddings):
+    """Deterministic feature-hashing embeddings
+
+    Words and word bigrams are hashed into a fixed number of signed
+    buckets. Needs no model file nor network, which makes it suitable for
+    tests and offline benchmarks, at the cost of retrieval quality.
+
+    Args:
+        dimension (int, optional): vector size. Defaults to 384.
+    """
+
+    def __init__(self, dimension: int = 384) -> None:
+        self.dimension = dimension
+
+    def _embed(self, text: str) -> list[float]:
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        words = re.findall(r"\w+", text.lower())
+        features = words + [" ".join(p) for p in zip(words, words[1:])]
+        for feature in features:
+            digest = hashlib.blake2b(
+                feature.encode("utf-8"), digest_size=8
+            ).digest()
+            value = int.from_bytes(digest, "little")
+            sign = 1.0 if value & 1 else -1.0
+            vector[(value >> 1) % self.dimension] += sign
+
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector.tolist()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embed(text)
+
+
+class OnnxEmbeddings(Embeddings):
+    """Sentence embeddings from a local ONNX transformer model
+
+    Runs on CPU with onnxruntime, token embeddings are mean-pooled and
+    L2-normalized (e.g. an exported all-MiniLM-L6-v2).
+
+    Args:
+        model_path (str | Path): path to the .onnx model
+        tokenizer_path (str | Path): path to the tokenizer.json file
+        max_length (int, optional): max tokens per text. Defaults to 256.
+        batch_size (int, optional): texts per inference. Defaults to 32.
+    """
+
+    def __init__(
+        self,
+        model_path: str | Path,
+        tokenizer_path: str | Path,
+        max_length: int = 256,
+        batch_size: int = 32,
+    ) -> None:
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        self.session = onnxruntime.InferenceSession(
+            str(model_path),
+            providers=["CPUExecutionProvider"],
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+        self.tokenizer = Tokenizer.from_file(str(tokenizer_path))
+        self.tokenizer.enable_truncation(max_length=max_length)
+        self.tokenizer.enable_padding()
+        self.batch_size = batch_size
+
+    def _embed(self, texts: list[str]) -> np.ndarray:
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.array(
+            [e.attention_mask for e in encodings], dtype=np.int64
+        )
+        inputs = {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "token_type_ids": np.zeros_like(input_ids),
+        }
+        inputs = {k: v for k, v in inputs.items() if k in self.input_names}
+
+        token_embeddings = self.session.run(None, inputs)[0]
+
+        mask = attention_mask[..., None].astype(np.float32)
+        summed = (token_embeddings * mask).sum(axis=1)
+        pooled = summed / np.clip(mask.sum(axis=1), 1e-9, None)
+        norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+        return pooled / np.clip(norms, 1e-12, None)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        vectors = []
+        for i in range(0, len(texts), self.batch_size):
+            vectors.extend(self._embed(texts[i : i + self.batch_size]))
+        return [v.tolist() for v in vectors]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embed([text])[0].tolist()
+
+
+def create_embeddings(provider: str, **kwargs) -> tuple[Embeddings, str]:
+    """Create the embeddings of a provider
+
+    Args:
+        provider (str): one of openai, onnx, hashing
+        **kwargs: provider settings from the config
+
+    Returns:
+        tuple[Embeddings, str]: embeddings and the model name, which
+        identifies the vectors they produce
+    """
+    if provider == "openai":
+        embeddings = rate_limited(OpenAIEmbeddings(model=kwargs["model"]))
+        return embeddings, embeddings.model
+
+    if provider == "onnx":
+        embeddings = OnnxEmbeddings(
+            model_path=kwargs["model_path"],
+            tokenizer_path=kwargs["tokenizer_path"],
+            max_length=kwargs.get("max_length", 256),
+            batch_size=kwargs.get("batch_size", 32),
+        )
+        return embeddings, "onnx:%s" % Path(kwargs["model_path"]).parent.name
+
+    if provider == "hashing":
+        dimension = kwargs.get("dimension", 384)
+        return HashingEmbeddings(dimension), "hashing:%d" % dimension
+
+    raise ValueError("Unknown embedding provider: %s" % provider)
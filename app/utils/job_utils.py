@@ -0,0 +1,241 @@
+import hashlib
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+from utils.config_utils import get_config
+from utils.logger_utils import get_logger
+
+config = get_config()
+
+logger = get_logger()
+
+
+@dataclass
+class Job:
+    """Background job, updated in place while it runs"""
+
+    id: str
+    kind: str
+    collection_id: str
+    key: str
+    status: str = "queued"  # queued, running, succeeded, failed, cancelled
+    progress: Any = None
+    result: Any = None
+    error: str | None = None
+    created_at: float = field(default_factory=time.time)
+    started_at: float | None = None
+    finished_at: float | None = None
+
+    @property
+    def active(self) -> bool:
+        return self.status in ("queued", "running")
+
+    def dict(self) -> dict[str, Any]:
+        progress = self.progress
+        if hasattr(progress, "dict"):
+            progress = progress.dict()
+
+        queued_seconds = run_seconds = None
+        if self.started_at:
+            queued_seconds = self.started_at - self.created_at
+            run_seconds = (self.finished_at or time.time()) - self.started_at
+
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "collection_id": self.collection_id,
+            "status": self.status,
+            "progress": progress,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "queued_seconds": queued_seconds,
+            "run_seconds": run_seconds,
+        }
+
+
+JobFunc = Callable[[Job], Any]
+
+
+def payload_hash(payload: Any) -> str:
+    data = json.dumps(payload, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class JobQueue:
+    """In-process job queue with bounded worker concurrency
+
+    Submitting a job identical to a queued or running one (same kind,
+    collection and payload) returns the existing job. Jobs of the same
+    collection run one at a time, in submission order, the next one is
+    handed to the workers when the previous one ends.
+
+    Args:
+        max_workers (int, optional): jobs running at once. Defaults to 2.
+        max_history (int, optional): finished jobs kept for status
+        queries. Defaults to 1000.
+    """
+
+    def __init__(self, max_workers: int = 2, max_history: int = 1000) -> None:
+        self.max_history = max_history
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix="job",
+        )
+        self._jobs: OrderedDict[str, Job] = OrderedDict()
+        self._active: dict[str, Job] = {}
+        # collections with a job running, and their jobs waiting for it
+        self._pending: dict[str, deque[tuple[Job, JobFunc]]] = {}
+        self._shutdown = False
+        self._lock = threading.Lock()
+
+    def submit(
+        self,
+        kind: str,
+        collection_id: str,
+        func: JobFunc,
+        payload: Any = None,
+        progress: Any = None,
+    ) -> Job:
+        """Queue a job
+
+        Args:
+            kind (str): job type, e.g. the endpoint that created it
+            collection_id (str): collection the job works on
+            func (JobFunc): called with the job, its return value becomes
+            the job result
+
+            payload (Any, optional): JSON serializable input, identifies
+            duplicate jobs. Defaults to None.
+
+            progress (Any, optional): progress object updated by `func`,
+            reported with the job if it has a `dict` method.
+            Defaults to None.
+
+        Returns:
+            Job: the queued job, or the identical job already queued.
+            Once the queue is shut down, a cancelled job
+        """
+        key = "%s:%s:%s" % (kind, collection_id, payload_hash(payload))
+        with self._lock:
+            job = self._active.get(key)
+            if job is not None and job.active:
+                logger.info("Job %s coalesced into %s" % (key, job.id))
+                return job
+
+            job = Job(
+                id=uuid.uuid4().hex,
+                kind=kind,
+                collection_id=collection_id,
+                key=key,
+                progress=progress,
+            )
+            self._jobs[job.id] = job
+            self._trim_history()
+            if self._shutdown:
+                self._cancel(job)
+                return job
+            self._active[key] = job
+
+            pending = self._pending.get(collection_id)
+            if pending is not None:
+                pending.append((job, func))
+                return job
+            self._pending[collection_id] = deque()
+
+        self._start(job, func)
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _start(self, job: Job, func: JobFunc) -> None:
+        try:
+            self._executor.submit(self._run, job, func)
+        except RuntimeError:
+            # the queue was shut down meanwhile
+            with self._lock:
+                self._cancel(job)
+
+    def _cancel(self, job: Job) -> None:
+        job.status = "cancelled"
+        job.error = "job queue is shut down"
+        job.finished_at = time.time()
+        if self._active.get(job.key) is job:
+            del self._active[job.key]
+
+    def _run(self, job: Job, func: JobFunc) -> None:
+        job.status = "running"
+        job.started_at = time.time()
+        try:
+            job.result = func(job)
+            job.status = "succeeded"
+        except Exception as err:
+            logger.exception(err)
+            job.error = str(err)
+            job.status = "failed"
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                if self._active.get(job.key) is job:
+                    del self._active[job.key]
+                next_job = self._next_job(job.collection_id)
+
+        logger.info("Job %s %s" % (job.id, job.status))
+        if next_job is not None:
+            self._start(*next_job)
+
+    def _next_job(self, collection_id: str) -> tuple[Job, JobFunc] | None:
+        pending = self._pending[collection_id]
+        if pending and not self._shutdown:
+            return pending.popleft()
+        # nothing left for the collection, forget it
+        del self._pending[collection_id]
+        return None
+
+    def _trim_history(self) -> None:
+        finished = [j.id for j in self._jobs.values() if not j.active]
+        for job_id in finished[: max(len(self._jobs) - self.max_history, 0)]:
+            del self._jobs[job_id]
+
+    def shutdown(self) -> None:
+        """Wait for running jobs, queued ones are cancelled"""
+        with self._lock:
+            self._shutdown = True
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+        # waiting behind a job of their collection, or cancelled by the
+        # executor before they started
+        with self._lock:
+            for job in self._jobs.values():
+                if job.status == "queued":
+                    self._cancel(job)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+        return {
+            status: statuses.count(status)
+            for status in (
+                "queued",
+                "running",
+                "succeeded",
+                "failed",
+                "cancelled",
+            )
+        }
+
+
+job_queue = JobQueue(
+    max_workers=config.llm.jobs.max_workers,
+    max_history=config.llm.jobs.max_history,
+)
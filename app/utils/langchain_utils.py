@@ -1,50 +1,855 @@
+import asyncio
+import json
 import shutil
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import AbstractContextManager, nullcontext
+from dataclasses import dataclass, field
+from functools import lru_cache
 from pathlib import Path
-from typing import Any
+from queue import Queue
+from typing import Any, Callable, Iterable, Iterator
 
+import numpy as np
 from langchain.chains import RetrievalQA
+from langchain.chains.combine_documents.base import BaseCombineDocumentsChain
 from langchain.chains.question_answering import load_qa_chain
 from langchain.chat_models import ChatOpenAI
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.schema import Document
-from langchain.text_splitter import CharacterTextSplitter
-from langchain.vectorstores import Chroma
+from langchain.embeddings.base import Embeddings
+from langchain.schema import BaseRetriever, Document
+from langchain.text_splitter import (
+    RecursiveCharacterTextSplitter,
+    TextSplitter,
+)
+from langchain.vectorstores.base import VectorStore
+from langchain.vectorstores.utils import maximal_marginal_relevance
+from utils.bm25_utils import BM25Index, reciprocal_rank_fusion
+from utils.cache_utils import LRUCache, ObjectRegistry
 from utils.config_utils import get_config
+from utils.dedup_utils import CHUNK, DOCUMENT, ContentHashSet
+from utils.embedding_utils import (
+    CachedEmbeddings,
+    EmbeddingCache,
+    create_embeddings,
+    text_hash,
+)
+from utils.llm_cache_utils import cached_completion
+from utils.lock_utils import RWLockManager
 from utils.logger_utils import get_logger
+from utils.openai_utils import rate_limited
+from utils.persist_utils import WriteBehindPersister
+from utils.registry_utils import (
+    CollectionRegistry,
+    dir_size,
+    get_collection_registry,
+)
+from utils.stream_utils import QueueCallbackHandler
+from utils.token_utils import count_tokens
+from utils.vectorstore_utils import (
+    EmbeddingVectorStore,
+    FaissVectorStore,
+    NumpyVectorStore,
+    ThreadSafeChroma,
+)
 
 config = get_config()
 
 logger = get_logger()
 
 
-def txts2docs(txts: list[str]) -> list[Document]:
-    return [Document(page_content=txt) for txt in txts]
+# queries of a collection run together, writes and deletes run alone
+_collection_locks = RWLockManager()
 
 
-def create_vectorstore_index(
-    docs: list[Document],
-    path: str | None = None,
-) -> Chroma:
-    text_splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
-    texts = text_splitter.split_documents(docs)
+def read_lock(collection_id: str) -> AbstractContextManager:
+    """Hold while querying a stored collection
 
-    embeddings = OpenAIEmbeddings()
+    Writes to the collection (adds, updates, persists, deletes) wait for
+    the readers, which must not call them while holding the lock.
+    """
+    return _collection_locks.read(str(collection_id))
 
-    if path:
-        persist_dir = Path(config.llm.langchain.persist_dir)
-        path = persist_dir / path
-        path.parent.mkdir(parents=True, exist_ok=True)
 
-    db = Chroma.from_documents(
-        texts,
+def write_lock(collection_id: str) -> AbstractContextManager:
+    """Hold while modifying a stored collection
+
+    Taken by the functions of this module that write, the thread holding
+    it may take it again.
+    """
+    return _collection_locks.write(str(collection_id))
+
+
+def get_lock_stats() -> dict[str, Any]:
+    return _collection_locks.stats()
+
+
+def _vectorstore_size(key: str, db: VectorStore) -> int:
+    path = Path(config.llm.langchain.persist_dir) / key
+    if not path.exists():
+        return 0
+    return dir_size(path)
+
+
+def _vectorstore_memory(key: str, db: VectorStore) -> int:
+    return db.memory_usage()
+
+
+def _on_vectorstore_evict(key: str, db: VectorStore) -> None:
+    _drop_keyword_reader(key)
+    # the write-behind persister holds on to stores with pending writes
+    # and persists them itself, at the latest on shutdown
+    if isinstance(db, ThreadSafeChroma):
+        db.release()
+
+
+def _persist_vectorstore(key: str, db: VectorStore) -> None:
+    with write_lock(key):
+        if not check_vectorstore_exists(key):
+            # deleted while waiting for the lock
+            return
+        db.persist()
+        _mark_unpersisted(key, False)
+        _get_registry().set_size(
+            REGISTRY_NAMESPACE, key, _vectorstore_size(key, db)
+        )
+        # chroma collections are measured by their persisted files
+        _vectorstore_cache.resize(key)
+        logger.info("Vectorstore %s persisted" % key)
+
+
+# small adds only mark a collection dirty, it is persisted in batches
+_write_behind = (
+    WriteBehindPersister(
+        _persist_vectorstore,
+        flush_interval=config.llm.langchain.write_behind.flush_interval,
+        max_pending=config.llm.langchain.write_behind.max_pending_chunks,
+    )
+    if config.llm.langchain.write_behind.enabled
+    else None
+)
+
+
+# opened vectorstores by collection id, so queries don't reload them.
+# the least recently used ones are closed past a budget of their
+# approximate memory
+_vectorstore_cache = LRUCache(
+    max_items=config.llm.langchain.vectorstore_cache.max_items,
+    max_bytes=config.llm.langchain.vectorstore_cache.max_size_mb * 1024**2,
+    # an evicted store with unpersisted writes stays with the write-behind
+    # persister until flushed, `load_vectorstore` reuses it meanwhile
+    sizeof=_vectorstore_memory,
+    on_evict=_on_vectorstore_evict,
+)
+# avoid opening two clients on the same collection on concurrent misses
+_vectorstore_load_lock = threading.Lock()
+
+# read-only connections to the keyword index of the queried collections,
+# dropped with their vectorstore
+_keyword_readers: dict[str, BM25Index] = {}
+_keyword_readers_lock = threading.Lock()
+
+
+def _get_keyword_reader(collection_id: str) -> BM25Index | None:
+    """Keyword index of a collection for searches, None if it has none"""
+    with _keyword_readers_lock:
+        reader = _keyword_readers.get(collection_id)
+        if reader is None:
+            path = Path(config.llm.langchain.persist_dir) / collection_id
+            if not BM25Index.exists(path):
+                return None
+            reader = _keyword_readers[collection_id] = BM25Index(
+                path, readonly=True
+            )
+        return reader
+
+
+def _drop_keyword_reader(collection_id: str) -> None:
+    # not closed, searches in flight keep the connection until they end
+    with _keyword_readers_lock:
+        _keyword_readers.pop(str(collection_id), None)
+
+
+_embedding_cache = (
+    EmbeddingCache(config.llm.langchain.embedding_cache.path)
+    if config.llm.langchain.embedding_cache.enabled
+    else None
+)
+
+
+COLLECTION_META_FILE = "collection.json"
+
+
+def read_collection_meta(path: str | Path) -> dict[str, Any]:
+    """Read the manifest stored next to a collection
+
+    Args:
+        path (str | Path): path to the vectorstore
+
+    Returns:
+        dict[str, Any]: manifest, empty if the collection has none
+    """
+    path = Path(config.llm.langchain.persist_dir) / path / COLLECTION_META_FILE
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text())
+
+
+def write_collection_meta(path: str | Path, meta: dict[str, Any]) -> None:
+    path = Path(config.llm.langchain.persist_dir) / path / COLLECTION_META_FILE
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(meta))
+
+
+def touch_collection(
+    path: str | Path,
+    documents: int = 0,
+    chunks: int = 0,
+) -> None:
+    """Record that a collection's content changed
+
+    Args:
+        path (str | Path): path to the vectorstore
+        documents (int, optional): change of the document count.
+        Defaults to 0.
+
+        chunks (int, optional): change of the chunk count. Defaults to 0.
+    """
+    meta = read_collection_meta(path)
+    meta["updated_at"] = time.time()
+    write_collection_meta(path, meta)
+
+    _get_registry().record_update(
+        REGISTRY_NAMESPACE,
+        str(path),
+        documents=documents,
+        chunks=chunks,
+        size_bytes=_vectorstore_size(str(path), None),
+    )
+
+
+REGISTRY_NAMESPACE = "langchain"
+
+
+def _describe_collection(path: Path) -> dict[str, Any]:
+    # collections built before the registry only have their manifest,
+    # counts stay unknown until they are rebuilt
+    meta = read_collection_meta(path.name)
+    stat = path.stat()
+    return {
+        "embedding_provider": meta.get("embedding_provider", "openai"),
+        "embedding_model": meta.get("embedding_model"),
+        "size_bytes": dir_size(path),
+        "created_at": stat.st_ctime,
+        "updated_at": meta.get("updated_at", stat.st_mtime),
+    }
+
+
+@lru_cache(maxsize=None)
+def _get_registry() -> CollectionRegistry:
+    registry = get_collection_registry()
+    registry.backfill(
+        REGISTRY_NAMESPACE,
+        config.llm.langchain.persist_dir,
+        describe=_describe_collection,
+    )
+    return registry
+
+
+def get_vectorstore_backend(collection_id: str | None = None) -> str:
+    """Backend configured for a new collection"""
+    vectorstore_config = config.llm.langchain.vectorstore
+    if collection_id:
+        return vectorstore_config.collections.get(
+            str(collection_id), vectorstore_config.default_backend
+        )
+    return vectorstore_config.default_backend
+
+
+def _open_vectorstore(
+    path: Path,
+    embeddings: Embeddings,
+    backend: str,
+) -> VectorStore:
+    if backend == "chroma":
+        return ThreadSafeChroma(
+            embedding_function=embeddings,
+            persist_directory=str(path),
+        )
+    if backend == "faiss":
+        return FaissVectorStore(
+            embeddings,
+            persist_directory=path,
+            **config.llm.langchain.vectorstore.faiss,
+        )
+    raise ValueError("Unknown vectorstore backend: %s" % backend)
+
+
+def get_embedding_provider(collection_id: str | None = None) -> str:
+    """Provider configured for a new collection"""
+    embedding_config = config.llm.langchain.embedding
+    if collection_id:
+        return embedding_config.collections.get(
+            str(collection_id), embedding_config.default_provider
+        )
+    return embedding_config.default_provider
+
+
+@lru_cache(maxsize=None)
+def _get_provider_embeddings(provider: str) -> tuple[Embeddings, str]:
+    provider_config = config.llm.langchain.embedding.providers[provider]
+    return create_embeddings(provider, **provider_config)
+
+
+def get_embeddings(provider: str = None, cached: bool = True) -> Embeddings:
+    """Embeddings of a provider, shared by all collections using it
+
+    Args:
+        provider (str, optional): one of openai, onnx, hashing.
+        Defaults to the configured default provider.
+
+        cached (bool, optional): use the embedding cache if enabled.
+        Defaults to True.
+
+    Returns:
+        Embeddings: embeddings, backed by the embedding cache if enabled
+    """
+    provider = provider or get_embedding_provider()
+    embeddings, model = _get_provider_embeddings(provider)
+
+    provider_config = config.llm.langchain.embedding.providers[provider]
+    if (
+        not cached
+        or _embedding_cache is None
+        or not provider_config.get("cache", True)
+    ):
+        return embeddings
+    return CachedEmbeddings(
         embeddings,
-        persist_directory=str(path),
+        cache=_embedding_cache,
+        model=model,
     )
-    if path:
+
+
+def get_embedding_cache_stats() -> dict[str, Any] | None:
+    if _embedding_cache is None:
+        return None
+    return _embedding_cache.stats()
+
+
+def invalidate_vectorstore(path: str | Path) -> bool:
+    """Drop a collection from the vectorstore cache
+
+    Args:
+        path (str | Path): path to the vectorstore
+
+    Returns:
+        bool: True if the collection was cached
+    """
+    _drop_keyword_reader(str(path))
+    return _vectorstore_cache.invalidate(str(path))
+
+
+def get_vectorstore_cache_stats() -> dict[str, Any]:
+    """Resident and evicted collections and bytes, with the approximate
+    memory of each resident collection, most recently used first"""
+    stats = _vectorstore_cache.stats()
+    stats["resident"] = [
+        {"collection_id": key, "bytes": size}
+        for key, size in reversed(_vectorstore_cache.sizes())
+    ]
+    return stats
+
+
+def _save_vectorstore(path: str | Path, db: VectorStore, chunks: int) -> None:
+    """Persist a modified collection, deferred in write-behind mode"""
+    if _write_behind is None:
         db.persist()
+        _mark_unpersisted(path, False)
+    else:
+        _write_behind.mark_dirty(str(path), db, pending=chunks)
 
-    logger.info("Vectorstore created with %d documents" % len(docs))
-    return db
+
+# present while a collection has writes that are not persisted. Its content
+# hashes and keyword index are written right away, if the process dies
+# they list chunks the persisted store doesn't have
+UNPERSISTED_FILE = "unpersisted"
+
+
+def _mark_unpersisted(path: str | Path, unpersisted: bool = True) -> None:
+    marker = Path(config.llm.langchain.persist_dir) / path / UNPERSISTED_FILE
+    if unpersisted:
+        marker.touch()
+    else:
+        marker.unlink(missing_ok=True)
+
+
+def _reconcile_collection(collection_id: str, db: VectorStore) -> None:
+    """Match the content hashes and keyword index of a collection to its
+    store, after writes that were never persisted"""
+    marker = (
+        Path(config.llm.langchain.persist_dir)
+        / collection_id
+        / UNPERSISTED_FILE
+    )
+    if not marker.exists():
+        return
+
+    logger.warning(
+        "Vectorstore %s lost unpersisted writes, reconciling its indexes"
+        % collection_id
+    )
+    hashes = _open_content_hashes(collection_id, db)
+    keyword_index = _open_keyword_index(collection_id, db)
+    try:
+        stored = db.get(include=["documents", "metadatas"])
+        if hashes is not None:
+            chunk_hashes = list(map(text_hash, stored["documents"]))
+            hashes.reconcile(
+                chunk_hashes,
+                refs=[
+                    (chunk_hash, metadata["doc_hash"])
+                    for chunk_hash, metadata in zip(
+                        chunk_hashes, stored["metadatas"]
+                    )
+                    if metadata and "doc_hash" in metadata
+                ],
+            )
+        if keyword_index is not None:
+            indexed = keyword_index.ids()
+            keyword_index.remove(indexed - set(stored["ids"]))
+            missing = [
+                (chunk_id, text)
+                for chunk_id, text in zip(stored["ids"], stored["documents"])
+                if chunk_id not in indexed
+            ]
+            keyword_index.add(
+                [chunk_id for chunk_id, _ in missing],
+                [text for _, text in missing],
+            )
+    finally:
+        _close(hashes, keyword_index)
+    marker.unlink()
+
+
+def flush_vectorstore(path: str | Path) -> bool:
+    """Persist pending writes of a collection now
+
+    Returns:
+        bool: True if the collection had pending writes
+    """
+    if _write_behind is None:
+        return False
+    return _write_behind.flush(str(path))
+
+
+def flush_vectorstores() -> int:
+    """Persist pending writes of every collection now
+
+    Returns:
+        int: number of collections persisted
+    """
+    if _write_behind is None:
+        return 0
+    return _write_behind.flush_all()
+
+
+def start_write_behind() -> None:
+    if _write_behind is not None:
+        _write_behind.start()
+
+
+def stop_write_behind() -> None:
+    """Stop background flushes and persist every pending write"""
+    if _write_behind is not None:
+        _write_behind.stop()
+
+
+def get_write_behind_stats() -> dict[str, Any] | None:
+    if _write_behind is None:
+        return None
+    return _write_behind.stats()
+
+
+def txts2docs(txts: list[str]) -> list[Document]:
+    # the hash is a stable id of the source document, chunks inherit it
+    return [
+        Document(page_content=txt, metadata={"doc_hash": text_hash(txt)})
+        for txt in txts
+    ]
+
+
+def ndjson2docs(lines: Iterable[bytes]) -> Iterator[Document]:
+    """Parse NDJSON documents, one per line
+
+    A line is either a JSON string or an object with a `text` string and
+    an optional `metadata` object. Blank lines are skipped.
+
+    Raises:
+        ValueError: a line is not a valid document
+    """
+    for line_no, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            if isinstance(record, str):
+                text, metadata = record, {}
+            else:
+                text, metadata = record["text"], record.get("metadata") or {}
+            if not isinstance(text, str) or not isinstance(metadata, dict):
+                raise TypeError("text must be a string, metadata an object")
+        except (ValueError, KeyError, TypeError) as err:
+            raise ValueError(
+                "Invalid document at line %d: %s" % (line_no, err)
+            )
+
+        yield Document(
+            page_content=text,
+            metadata={**metadata, "doc_hash": text_hash(text)},
+        )
+
+
+@lru_cache(maxsize=None)
+def get_text_splitter() -> TextSplitter:
+    """Splitter measuring chunks in tokens of the configured chat model
+
+    Chunks then fill the QA chain context predictably, whatever the
+    language or formatting of the documents.
+    """
+    splitter_config = config.llm.langchain.splitter
+    model_name = config.llm.model_name
+    return RecursiveCharacterTextSplitter(
+        chunk_size=splitter_config.chunk_size,
+        chunk_overlap=splitter_config.chunk_overlap,
+        length_function=lambda text: count_tokens(text, model_name),
+    )
+
+
+@dataclass
+class IngestProgress:
+    """Progress of an ingestion, updated in place while it runs"""
+
+    documents: int = 0
+    chunks: int = 0
+    batches: int = 0
+    # already stored, or repeated in the same ingestion
+    skipped_documents: int = 0
+    skipped_chunks: int = 0
+    done: bool = False
+    started_at: float = field(default_factory=time.perf_counter)
+    finished_at: float | None = None
+
+    @property
+    def elapsed(self) -> float:
+        end = self.finished_at or time.perf_counter()
+        return end - self.started_at
+
+    @property
+    def chunks_per_second(self) -> float:
+        elapsed = self.elapsed
+        return self.chunks / elapsed if elapsed > 0 else 0.0
+
+    def dict(self) -> dict[str, Any]:
+        return {
+            "documents": self.documents,
+            "chunks": self.chunks,
+            "batches": self.batches,
+            "skipped_documents": self.skipped_documents,
+            "skipped_chunks": self.skipped_chunks,
+            "done": self.done,
+            "elapsed_seconds": round(self.elapsed, 3),
+            "chunks_per_second": round(self.chunks_per_second, 2),
+        }
+
+
+ProgressCallback = Callable[[IngestProgress], None]
+
+
+def iter_chunks(
+    docs: Iterable[Document],
+    progress: IngestProgress = None,
+) -> Iterator[Document]:
+    """Split documents lazily, one document at a time"""
+    text_splitter = get_text_splitter()
+    for doc in docs:
+        if progress:
+            progress.documents += 1
+        yield from text_splitter.split_documents([doc])
+
+
+def _doc_hash(doc: Document) -> str:
+    doc_hash = doc.metadata.get("doc_hash")
+    if doc_hash is None:
+        doc_hash = doc.metadata["doc_hash"] = text_hash(doc.page_content)
+    return doc_hash
+
+
+def iter_new_documents(
+    docs: Iterable[Document],
+    hashes: ContentHashSet,
+    seen: set[str],
+    progress: IngestProgress = None,
+) -> Iterator[Document]:
+    """Documents whose hash is neither stored nor in `seen`
+
+    The hashes of the returned documents are added to `seen`.
+    """
+    for batch in iter_batches(docs, 500):
+        stored = hashes.contains(DOCUMENT, map(_doc_hash, batch))
+        for doc in batch:
+            doc_hash = _doc_hash(doc)
+            if doc_hash in stored or doc_hash in seen:
+                if progress:
+                    progress.skipped_documents += 1
+                continue
+            seen.add(doc_hash)
+            yield doc
+
+
+def iter_batches(items: Iterable[Any], size: int) -> Iterator[list[Any]]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _add_embeddings(
+    db: VectorStore,
+    chunks: list[Document],
+    embeddings: list[list[float]],
+) -> list[str]:
+    if isinstance(db, EmbeddingVectorStore):
+        return db.add_embeddings(chunks, embeddings)
+
+    ids = [str(uuid.uuid1()) for _ in chunks]
+    metadatas = [chunk.metadata for chunk in chunks]
+    db._collection.add(
+        ids=ids,
+        embeddings=embeddings,
+        metadatas=metadatas if any(metadatas) else None,
+        documents=[chunk.page_content for chunk in chunks],
+    )
+    return ids
+
+
+def ingest_documents(
+    docs: Iterable[Document],
+    db: VectorStore,
+    batch_size: int = None,
+    max_concurrency: int = None,
+    progress: IngestProgress = None,
+    on_progress: ProgressCallback = None,
+    hashes: ContentHashSet = None,
+    keyword_index: BM25Index = None,
+) -> IngestProgress:
+    """Split, embed and add documents to a vectorstore in batches
+
+    Documents are split as they are consumed, chunks are embedded in
+    batches of `batch_size` with at most `max_concurrency` embedding
+    requests in flight, and each embedded batch is written to the store
+    in a single call, in order. The store is not persisted.
+
+    With `hashes`, documents and chunks whose content is already stored
+    or repeated are skipped before being embedded, and the hashes of the
+    written ones are recorded. A chunk shared by two documents is stored
+    once, with the first document, and recorded as contained by both.
+
+    Args:
+        docs (Iterable[Document]): documents, may be a generator
+        db (VectorStore): vectorstore to add the chunks to
+        batch_size (int, optional): chunks per embedding request.
+        Defaults to config.llm.langchain.ingest.batch_size.
+
+        max_concurrency (int, optional): maximum embedding requests in
+        flight. Defaults to config.llm.langchain.ingest.max_concurrency.
+
+        progress (IngestProgress, optional): progress object to update,
+        lets the caller watch it from another thread. Defaults to None.
+
+        on_progress (ProgressCallback, optional): called after every
+        written batch. Defaults to None.
+
+        hashes (ContentHashSet, optional): content hashes of the stored
+        documents and chunks. Defaults to None (no deduplication).
+
+        keyword_index (BM25Index, optional): keyword index the written
+        chunks are added to. Defaults to None.
+
+    Returns:
+        IngestProgress: final progress
+    """
+    batch_size = batch_size or config.llm.langchain.ingest.batch_size
+    max_concurrency = (
+        max_concurrency or config.llm.langchain.ingest.max_concurrency
+    )
+    progress = progress or IngestProgress()
+    embeddings = db._embedding_function
+
+    new_docs: set[str] = set()
+    # chunks being embedded, not yet in `hashes`
+    pending_chunks: set[str] = set()
+    # (chunk, document) hashes of the new documents, skipped chunks too
+    refs: set[tuple[str, str]] = set()
+    if hashes is not None:
+        docs = iter_new_documents(docs, hashes, new_docs, progress)
+
+    def write(batch: list[Document], future: Future) -> None:
+        ids = _add_embeddings(db, batch, future.result())
+        if keyword_index is not None:
+            keyword_index.add(ids, [chunk.page_content for chunk in batch])
+        if hashes is not None:
+            batch_hashes = [text_hash(chunk.page_content) for chunk in batch]
+            hashes.add(CHUNK, batch_hashes)
+            pending_chunks.difference_update(batch_hashes)
+        progress.chunks += len(batch)
+        progress.batches += 1
+        if on_progress:
+            on_progress(progress)
+
+    def new_chunks(batch: list[Document]) -> list[Document]:
+        batch_hashes = [text_hash(chunk.page_content) for chunk in batch]
+        stored = hashes.contains(CHUNK, batch_hashes) | pending_chunks
+        chunks = []
+        for chunk, chunk_hash in zip(batch, batch_hashes):
+            refs.add((chunk_hash, chunk.metadata["doc_hash"]))
+            if chunk_hash in stored:
+                progress.skipped_chunks += 1
+                continue
+            stored.add(chunk_hash)
+            pending_chunks.add(chunk_hash)
+            chunks.append(chunk)
+        return chunks
+
+    pending: deque[tuple[list[Document], Future]] = deque()
+    try:
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            chunks = iter_chunks(docs, progress=progress)
+            for batch in iter_batches(chunks, batch_size):
+                if hashes is not None:
+                    batch = new_chunks(batch)
+                    if not batch:
+                        continue
+                texts = [chunk.page_content for chunk in batch]
+                future = executor.submit(embeddings.embed_documents, texts)
+                pending.append((batch, future))
+
+                # bound the batches held in memory to the ones being embedded
+                if len(pending) >= max_concurrency:
+                    write(*pending.popleft())
+
+            while pending:
+                write(*pending.popleft())
+    finally:
+        if hashes is not None:
+            # on failure too, the chunks written so far can be removed with
+            # their documents. Chunks never written have no refs
+            hashes.add_refs(
+                ref for ref in refs if ref[0] not in pending_chunks
+            )
+
+    if hashes is not None:
+        # only once all their chunks are stored, a document ingested
+        # partially is ingested again and its stored chunks are skipped
+        hashes.add(DOCUMENT, new_docs)
+
+    progress.done = True
+    progress.finished_at = time.perf_counter()
+    if on_progress:
+        on_progress(progress)
+
+    logger.info("Ingested documents: %s" % progress.dict())
+    return progress
+
+
+def create_vectorstore_index(
+    docs: Iterable[Document],
+    path: str | None = None,
+    progress: IngestProgress = None,
+    on_progress: ProgressCallback = None,
+    provider: str = None,
+    backend: str = None,
+) -> VectorStore:
+    """Create a vectorstore from documents
+
+    Without a path the documents are indexed in memory only, for one-off
+    queries. Stored collections use `backend` (chroma or faiss), by
+    default the one configured for the collection.
+    """
+    start = time.perf_counter()
+    provider = provider or get_embedding_provider(path)
+    backend = backend or get_vectorstore_backend(path)
+    # one-off documents are not worth a write to the embedding cache
+    embeddings = get_embeddings(provider, cached=bool(path))
+
+    with write_lock(path) if path else nullcontext():
+        collection_id = None
+        if path:
+            collection_id = str(path)
+            invalidate_vectorstore(collection_id)
+
+            persist_dir = Path(config.llm.langchain.persist_dir)
+            path = persist_dir / path
+            path.parent.mkdir(parents=True, exist_ok=True)
+            if path.exists():
+                # left behind by an interrupted build or a deleted collection
+                # persisted again at exit, it must not leak into the new one
+                shutil.rmtree(path)
+
+            db = _open_vectorstore(path, embeddings, backend)
+        else:
+            db = NumpyVectorStore(embeddings)
+
+        hashes = _open_content_hashes(collection_id, db) if path else None
+        keyword_index = (
+            _open_keyword_index(collection_id, db) if path else None
+        )
+        try:
+            progress = ingest_documents(
+                docs,
+                db,
+                progress=progress,
+                on_progress=on_progress,
+                hashes=hashes,
+                keyword_index=keyword_index,
+            )
+        finally:
+            _close(hashes, keyword_index)
+        if path:
+            db.persist()
+            model = _get_provider_embeddings(provider)[1]
+            # queries must embed with the provider that built the collection
+            write_collection_meta(
+                collection_id,
+                {
+                    "embedding_provider": provider,
+                    "embedding_model": model,
+                    "backend": backend,
+                    "updated_at": time.time(),
+                },
+            )
+            _get_registry().register(
+                REGISTRY_NAMESPACE,
+                collection_id,
+                documents=progress.documents,
+                chunks=progress.chunks,
+                embedding_provider=provider,
+                embedding_model=model,
+                size_bytes=dir_size(path),
+                build_seconds=time.perf_counter() - start,
+            )
+            _vectorstore_cache.put(collection_id, db)
+
+        logger.info(
+            "Vectorstore created with %d documents" % progress.documents
+        )
+        return db
 
 
 # still not working
@@ -67,13 +872,41 @@ def create_vectorstore_index(
 
 def load_vectorstore(
     path: str | Path,
-) -> Chroma:
-    persist_dir = Path(config.llm.langchain.persist_dir)
-    if path:
-        path = persist_dir / path
+) -> VectorStore:
+    collection_id = str(path) if path else None
+    if collection_id:
+        db = _vectorstore_cache.get(collection_id)
+        if db is not None:
+            return db
+
+    with _vectorstore_load_lock:
+        if collection_id:
+            # another thread may have loaded it while we were waiting
+            if collection_id in _vectorstore_cache:
+                return _vectorstore_cache.get(collection_id)
+
+        persist_dir = Path(config.llm.langchain.persist_dir)
+        if path:
+            path = persist_dir / path
 
-    embedding = OpenAIEmbeddings()
-    db = Chroma(persist_directory=str(path), embedding_function=embedding)
+        # collections created before providers and backends were recorded
+        # used openai and chroma
+        meta = read_collection_meta(collection_id) if collection_id else {}
+        provider = meta.get("embedding_provider", "openai")
+        backend = meta.get("backend", "chroma")
+
+        db = None
+        if _write_behind is not None and collection_id:
+            # evicted before its writes were persisted, the files are stale
+            db = _write_behind.pending_store(collection_id)
+        if db is None:
+            embedding = get_embeddings(provider)
+            db = _open_vectorstore(path, embedding, backend)
+            if collection_id:
+                _reconcile_collection(collection_id, db)
+
+        if collection_id:
+            _vectorstore_cache.put(collection_id, db)
 
     logger.info("Vectorstore loaded from %s" % str(path))
 
@@ -81,8 +914,46 @@ def load_vectorstore(
 
 
 def list_vectorstore() -> list[str]:
+    return _get_registry().ids(REGISTRY_NAMESPACE)
+
+
+def list_vectorstore_info(
+    offset: int = 0,
+    limit: int = None,
+) -> list[dict[str, Any]]:
+    """Registry entries of the stored collections, by collection id
+
+    Args:
+        offset (int, optional): entries to skip. Defaults to 0.
+        limit (int, optional): maximum number of entries.
+        Defaults to None (all).
+
+    Returns:
+        list[dict[str, Any]]: counts, embedding model, size on disk,
+        timestamps and build duration of each collection
+    """
+    return _get_registry().list(REGISTRY_NAMESPACE, offset, limit)
+
+
+def get_vectorstore_info(path: str | Path) -> dict[str, Any] | None:
+    info = _get_registry().get(REGISTRY_NAMESPACE, str(path))
+    if info is None:
+        return None
+
     persist_dir = Path(config.llm.langchain.persist_dir)
-    return [str(path.name) for path in persist_dir.glob("*") if path.is_dir()]
+    info["quantization"] = FaissVectorStore.read_quantization_report(
+        persist_dir / str(path)
+    )
+    return info
+
+
+def get_vectorstore_registry_stats() -> dict[str, Any]:
+    return _get_registry().stats(REGISTRY_NAMESPACE)
+
+
+def record_vectorstore_query(path: str | Path) -> None:
+    """Record that a stored collection was queried"""
+    _get_registry().record_query(REGISTRY_NAMESPACE, str(path))
 
 
 def delete_vectorstore(
@@ -96,65 +967,628 @@ def delete_vectorstore(
     Returns:
         bool: ok. Return True if successful else False
     """
-    persist_dir = Path(config.llm.langchain.persist_dir)
-    path = persist_dir / path
-    if not path.exists():
-        return False
+    with write_lock(path):
+        if _write_behind is not None:
+            _write_behind.discard(str(path))
+        invalidate_vectorstore(path)
+        registered = _get_registry().remove(REGISTRY_NAMESPACE, str(path))
 
-    shutil.rmtree(path)
+        persist_dir = Path(config.llm.langchain.persist_dir)
+        path = persist_dir / path
+        if not path.exists():
+            return registered
+
+        shutil.rmtree(path)
 
-    return True
+        return True
 
 
 def check_vectorstore_exists(path: Path | str) -> bool:
-    persist_dir = Path(config.llm.langchain.persist_dir)
-    path = persist_dir / path
-    return path.exists()
+    return _get_registry().exists(REGISTRY_NAMESPACE, str(path))
+
+
+def _open_content_hashes(
+    collection_id: str | Path,
+    db: VectorStore,
+) -> ContentHashSet | None:
+    """Content hashes of a stored collection, None if dedup is disabled"""
+    if not config.llm.langchain.ingest.dedup:
+        return None
+
+    path = Path(config.llm.langchain.persist_dir) / collection_id
+    hashes = ContentHashSet(path)
+    if hashes.created:
+        # built before deduplication, or just created and still empty
+        stored = db.get(include=["documents", "metadatas"])
+        refs = {
+            (text_hash(text), metadata["doc_hash"])
+            for text, metadata in zip(stored["documents"], stored["metadatas"])
+            if metadata and "doc_hash" in metadata
+        }
+        hashes.add(CHUNK, map(text_hash, stored["documents"]))
+        hashes.add(DOCUMENT, {doc_hash for _, doc_hash in refs})
+        hashes.add_refs(refs)
+    return hashes
+
+
+def _open_keyword_index(
+    collection_id: str | Path,
+    db: VectorStore,
+) -> BM25Index | None:
+    """Keyword index of a stored collection, None if hybrid search is
+    disabled"""
+    if not config.llm.langchain.hybrid.enabled:
+        return None
+
+    path = Path(config.llm.langchain.persist_dir) / collection_id
+    backfill = not BM25Index.exists(path)
+    keyword_index = BM25Index(path)
+    if backfill:
+        # built before hybrid search, or just created and still empty
+        stored = db.get(include=["documents"])
+        keyword_index.add(stored["ids"], stored["documents"])
+    return keyword_index
+
+
+def _close(*indexes: ContentHashSet | BM25Index | None) -> None:
+    for index in indexes:
+        if index is not None:
+            index.close()
 
 
 def add_docs_to_vectorstore(
+    docs: Iterable[Document],
+    path: str | Path,
+    progress: IngestProgress = None,
+) -> VectorStore:
+    """Add documents to a stored collection
+
+    The collection is loaded under its write lock, a store loaded before
+    could have been evicted and reloaded by a reader meanwhile.
+
+    Args:
+        docs (Iterable[Document]): documents, may be a generator
+        path (str | Path): path to the vectorstore
+        progress (IngestProgress, optional): progress object to update.
+        Defaults to None.
+
+    Returns:
+        VectorStore: the updated vectorstore
+    """
+    with write_lock(path):
+        if not check_vectorstore_exists(path):
+            # deleted while waiting for the lock
+            raise ValueError("index does not exists")
+
+        db = load_vectorstore(path)
+        _mark_unpersisted(path)
+        hashes = _open_content_hashes(path, db)
+        keyword_index = _open_keyword_index(path, db)
+        progress = progress or IngestProgress()
+        try:
+            ingest_documents(
+                docs,
+                db,
+                progress=progress,
+                hashes=hashes,
+                keyword_index=keyword_index,
+            )
+        finally:
+            _close(hashes, keyword_index)
+            # on failure too, the batches written before it are in the
+            # cached store. Its documents aren't counted, see
+            # `ingest_documents`
+            if progress.done or progress.chunks:
+                _save_vectorstore(path, db, progress.chunks)
+                # the cached store was updated in place, refresh its size
+                _vectorstore_cache.resize(str(path))
+                touch_collection(
+                    path,
+                    documents=progress.documents if progress.done else 0,
+                    chunks=progress.chunks,
+                )
+        logger.info("Added %d documents to vectorstore" % progress.documents)
+        return db
+
+
+def update_vectorstore_index(
     docs: list[Document],
-    db: Chroma,
-) -> Chroma:
-    added_indexes = db.add_documents(docs)
-    db.persist()
-    logger.info("Added %d documents to vectorstore" % len(added_indexes))
-    return db
+    path: str | Path,
+) -> dict[str, int]:
+    """Bring a stored collection in line with `docs`
+
+    Documents are matched by the `doc_hash` metadata set by `txts2docs`:
+    only chunks of new documents are embedded and added, only chunks of
+    documents missing from `docs` are deleted, and the collection is
+    persisted once.
+
+    Args:
+        docs (list[Document]): full list of documents of the collection
+        path (str | Path): path to the vectorstore
+
+    Returns:
+        dict[str, int]: number of added and deleted documents and chunks
+    """
+    with write_lock(path):
+        if not check_vectorstore_exists(path):
+            # deleted while waiting for the lock
+            raise ValueError("index does not exists")
+
+        db = load_vectorstore(path)
+        hashes = _open_content_hashes(path, db)
+        keyword_index = _open_keyword_index(path, db)
+        stored = db.get(
+            include=(
+                ["metadatas", "documents"]
+                if hashes is not None
+                else ["metadatas"]
+            )
+        )
+
+        stored_ids: dict[str, list[str]] = {}
+        untracked_ids = []
+        chunk_hashes: dict[str, str] = {}
+        for i, (chunk_id, metadata) in enumerate(
+            zip(stored["ids"], stored["metadatas"])
+        ):
+            doc_hash = (metadata or {}).get("doc_hash")
+            if doc_hash is None:
+                untracked_ids.append(chunk_id)
+            else:
+                stored_ids.setdefault(doc_hash, []).append(chunk_id)
+            if hashes is not None:
+                chunk_hashes[chunk_id] = text_hash(stored["documents"][i])
+
+        if untracked_ids:
+            # built before documents were tracked by hash, can't diff those
+            logger.info(
+                "Vectorstore %s has %d untracked chunks, re-indexing them"
+                % (str(path), len(untracked_ids))
+            )
+
+        # chunks are stored once, with the first document containing them,
+        # the content hashes know every document containing a chunk
+        known = (
+            hashes.members(DOCUMENT) if hashes is not None else set(stored_ids)
+        )
 
+        new_docs: dict[str, Document] = {}
+        for doc in docs:
+            doc_hash = doc.metadata.get("doc_hash") or text_hash(
+                doc.page_content
+            )
+            if doc_hash not in known and doc_hash not in new_docs:
+                doc.metadata["doc_hash"] = doc_hash
+                new_docs[doc_hash] = doc
 
-def get_retrieval_qa_chain(db: Chroma) -> RetrievalQA:
-    llm = ChatOpenAI(
-        model_name=config.llm.model_name,
-        temperature=config.llm.temperature,
+        keep = {doc.metadata.get("doc_hash") for doc in docs}
+        removed = [h for h in known if h not in keep]
+        if removed or untracked_ids or new_docs:
+            _mark_unpersisted(path)
+        removed_ids = list(untracked_ids)
+        if hashes is None:
+            removed_ids += [i for h in removed for i in stored_ids[h]]
+        else:
+            # a chunk still contained by a kept document stays
+            orphans = hashes.remove_documents(
+                removed,
+                chunks={
+                    chunk_hashes[i]
+                    for h, ids in stored_ids.items()
+                    if h not in keep
+                    for i in ids
+                },
+            )
+            untracked = set(untracked_ids)
+            removed_ids += [
+                i
+                for i, chunk_hash in chunk_hashes.items()
+                if chunk_hash in orphans and i not in untracked
+            ]
+
+        if removed_ids:
+            _delete_chunks(db, removed_ids)
+            if hashes is not None:
+                remaining = {
+                    chunk_hashes[i]
+                    for i in set(chunk_hashes) - set(removed_ids)
+                }
+                hashes.remove(
+                    CHUNK,
+                    {chunk_hashes[i] for i in untracked_ids} - remaining,
+                )
+            if keyword_index is not None:
+                keyword_index.remove(removed_ids)
+
+        try:
+            progress = ingest_documents(
+                new_docs.values(),
+                db,
+                hashes=hashes,
+                keyword_index=keyword_index,
+            )
+        finally:
+            _close(hashes, keyword_index)
+
+        if removed or removed_ids or progress.chunks:
+            _save_vectorstore(path, db, len(removed_ids) + progress.chunks)
+            _vectorstore_cache.resize(str(path))
+            touch_collection(
+                path,
+                documents=progress.documents - len(removed),
+                chunks=progress.chunks - len(removed_ids),
+            )
+
+        stats = {
+            "added_documents": progress.documents,
+            "added_chunks": progress.chunks,
+            "skipped_chunks": progress.skipped_chunks,
+            "deleted_documents": len(removed),
+            "deleted_chunks": len(removed_ids),
+        }
+        logger.info("Vectorstore %s updated: %s" % (str(path), stats))
+        return stats
+
+
+def _delete_chunks(db: VectorStore, ids: list[str]) -> None:
+    if isinstance(db, FaissVectorStore):
+        db.delete(ids)
+    else:
+        db._collection.delete(ids=ids)
+
+
+def _query_with_embeddings(
+    db: VectorStore,
+    embedding: list[float],
+    n: int,
+) -> tuple[list[Document], np.ndarray]:
+    """Nearest chunks of an embedding, with their stored embeddings"""
+    if isinstance(db, EmbeddingVectorStore):
+        docs, vectors, _ = db.query_with_embeddings(embedding, n)
+        return docs, vectors
+
+    with db.query_lock:
+        n = min(n, db._collection.count())
+        if n <= 0:
+            return [], np.empty((0, len(embedding)), dtype=np.float32)
+
+        results = db._collection.query(
+            query_embeddings=[embedding],
+            n_results=n,
+            include=["documents", "metadatas", "embeddings"],
+        )
+    docs = [
+        Document(page_content=text, metadata=metadata or {})
+        for text, metadata in zip(
+            results["documents"][0], results["metadatas"][0]
+        )
+    ]
+    return docs, np.array(results["embeddings"][0], dtype=np.float32)
+
+
+def search_vectorstore(
+    db: VectorStore,
+    query: str,
+    k: int = 4,
+    mmr: bool = False,
+    fetch_k: int = 20,
+    lambda_mult: float = 0.5,
+) -> list[dict[str, Any]]:
+    """Retrieve the chunks most similar to a query, without the LLM
+
+    Args:
+        db (VectorStore): vectorstore
+        query (str): query text
+        k (int, optional): number of chunks to return. Defaults to 4.
+        mmr (bool, optional): diversify the results with maximal marginal
+        relevance. Defaults to False.
+
+        fetch_k (int, optional): candidates considered by MMR.
+        Defaults to 20.
+
+        lambda_mult (float, optional): MMR trade-off between relevance (1)
+        and diversity (0). Defaults to 0.5.
+
+    Returns:
+        list[dict[str, Any]]: chunks with their content, metadata and
+        cosine similarity score, best first
+    """
+    embedding = db._embedding_function.embed_query(query)
+    docs, vectors = _query_with_embeddings(
+        db, embedding, max(k, fetch_k) if mmr else k
     )
+    if not docs:
+        return []
+
+    query_vector = np.array(embedding, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query_vector)
+    scores = vectors @ query_vector / np.clip(norms, 1e-12, None)
+
+    if mmr:
+        idxs = maximal_marginal_relevance(
+            query_vector, vectors, lambda_mult=lambda_mult, k=k
+        )
+    else:
+        idxs = list(range(len(docs)))
+
+    return [
+        {
+            "content": docs[i].page_content,
+            "metadata": docs[i].metadata,
+            "score": float(scores[i]),
+        }
+        for i in idxs
+    ]
+
+
+# chat models and QA chains are stateless between calls (callbacks are
+# passed per call), so one instance per configuration serves all requests
+_llm_registry = ObjectRegistry()
+
+
+def get_chat_model(
+    model_name: str = None,
+    temperature: float = None,
+    streaming: bool = False,
+) -> ChatOpenAI:
+    model_name = model_name or config.llm.model_name
+    if temperature is None:
+        temperature = config.llm.temperature
+
+    return _llm_registry.get_or_create(
+        ("chat_model", model_name, temperature, streaming),
+        lambda: rate_limited(
+            ChatOpenAI(
+                model_name=model_name,
+                temperature=temperature,
+                streaming=streaming,
+            )
+        ),
+    )
+
+
+def get_qa_chain(
+    model_name: str = None,
+    temperature: float = None,
+    chain_type: str = None,
+    streaming: bool = False,
+) -> BaseCombineDocumentsChain:
+    model_name = model_name or config.llm.model_name
+    if temperature is None:
+        temperature = config.llm.temperature
+    chain_type = chain_type or config.llm.langchain.qa_chain_type
+
+    return _llm_registry.get_or_create(
+        ("qa_chain", model_name, temperature, chain_type, streaming),
+        lambda: load_qa_chain(
+            get_chat_model(model_name, temperature, streaming),
+            chain_type=chain_type,
+        ),
+    )
+
+
+class HybridRetriever(BaseRetriever):
+    """Vector and BM25 keyword search of a stored collection, merged with
+    reciprocal rank fusion
+
+    Chunks holding the exact identifiers of a query (order numbers, names,
+    dates), which embeddings tend to miss, rank high in the keyword search
+    and make it into the `k` results without retrieving more chunks.
+
+    Args:
+        db (VectorStore): vectorstore of the collection
+        collection_id (str): id of the collection
+        k (int, optional): number of chunks returned. Defaults to 2.
+        fetch_k (int, optional): candidates of each search.
+        Defaults to config.llm.langchain.hybrid.fetch_k.
+
+        rrf_k (int, optional): rank offset of the fusion, higher values
+        flatten the gap between top ranks.
+        Defaults to config.llm.langchain.hybrid.rrf_k.
+    """
+
+    def __init__(
+        self,
+        db: VectorStore,
+        collection_id: str,
+        k: int = 2,
+        fetch_k: int = None,
+        rrf_k: int = None,
+    ) -> None:
+        self.db = db
+        self.collection_id = collection_id
+        self.k = k
+        self.fetch_k = max(k, fetch_k or config.llm.langchain.hybrid.fetch_k)
+        self.rrf_k = rrf_k or config.llm.langchain.hybrid.rrf_k
+
+    def _keyword_search(self, query: str) -> list[Document]:
+        keyword_index = _get_keyword_reader(self.collection_id)
+        if keyword_index is None:
+            return []
+
+        hits = keyword_index.search(query, self.fetch_k)
+        if not hits:
+            return []
+
+        stored = self.db.get(
+            include=["documents", "metadatas"],
+            ids=[chunk_id for chunk_id, _ in hits],
+        )
+        docs = {
+            chunk_id: Document(page_content=text, metadata=metadata or {})
+            for chunk_id, text, metadata in zip(
+                stored["ids"], stored["documents"], stored["metadatas"]
+            )
+        }
+        # ids of chunks whose vectors were never persisted may be missing
+        return [docs[chunk_id] for chunk_id, _ in hits if chunk_id in docs]
+
+    def get_relevant_documents(self, query: str) -> list[Document]:
+        embedding = self.db._embedding_function.embed_query(query)
+        vector_docs, _ = _query_with_embeddings(
+            self.db, embedding, self.fetch_k
+        )
+        keyword_docs = self._keyword_search(query)
+
+        # the same chunk found by both searches has the same content
+        docs = {doc.page_content: doc for doc in keyword_docs + vector_docs}
+        fused = reciprocal_rank_fusion(
+            [
+                [doc.page_content for doc in vector_docs],
+                [doc.page_content for doc in keyword_docs],
+            ],
+            k=self.rrf_k,
+        )
+        return [docs[content] for content, _ in fused[: self.k]]
+
+    async def aget_relevant_documents(self, query: str) -> list[Document]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, self.get_relevant_documents, query
+        )
 
-    combine_docs_chain = load_qa_chain(
-        llm,
-        chain_type=config.llm.langchain.qa_chain_type,
+
+def get_retriever(
+    db: VectorStore,
+    collection_id: str = None,
+    k: int = 2,
+) -> BaseRetriever:
+    """Hybrid retriever of a stored collection with a keyword index, plain
+    vector search otherwise"""
+    if collection_id and config.llm.langchain.hybrid.enabled:
+        path = Path(config.llm.langchain.persist_dir) / collection_id
+        if BM25Index.exists(path):
+            return HybridRetriever(db, collection_id, k=k)
+
+    return db.as_retriever(
+        search_kwargs={
+            "k": k,
+        },
     )
+
+
+def get_retrieval_qa_chain(
+    db: VectorStore,
+    streaming: bool = False,
+    collection_id: str = None,
+) -> RetrievalQA:
+    # only the retriever is specific to the request
+    combine_docs_chain = get_qa_chain(streaming=streaming)
     qa = RetrievalQA(
         combine_documents_chain=combine_docs_chain,
-        retriever=db.as_retriever(
-            search_kwargs={
-                "k": 2,
-            },
-        ),
+        retriever=get_retriever(db, collection_id),
     )
     return qa
 
 
 def query_vectorstore(
-    db: Chroma,
+    db: VectorStore,
     query: str,
+    collection_id: str = None,
+    no_cache: bool = False,
 ) -> dict[str, Any]:
+    """Answer a query with the documents of a vectorstore
+
+    Args:
+        db (VectorStore): vectorstore
+        query (str): question
+        collection_id (str, optional): id of a stored collection, enables
+        the semantic cache and is read locked during the retrieval.
+        Defaults to None.
+
+        no_cache (bool, optional): skip the semantic cache lookup.
+        Defaults to False.
+
+    Returns:
+        dict[str, Any]: query and result
+    """
     # Search for similarity documents
     # docs = db.similarity_search(query)
     # print(docs)
 
-    qa = get_retrieval_qa_chain(db)
-    result = qa(
+    def complete() -> str:
+        qa = get_retrieval_qa_chain(db, collection_id=collection_id)
+        # not while the answer is generated, a waiting write would make
+        # every new query wait for the slowest answer in flight
+        with read_lock(collection_id) if collection_id else nullcontext():
+            docs = qa.retriever.get_relevant_documents(query)
+        return qa.combine_documents_chain.run(
+            input_documents=docs,
+            question=query,
+        )
+
+    if not collection_id:
+        return {"query": query, "result": complete()}
+
+    # answers are only reused until the collection changes
+    updated_at = read_collection_meta(collection_id).get("updated_at", 0)
+    answer = cached_completion(
+        "collection:%s:%s" % (collection_id, updated_at),
+        query,
+        complete,
+        bypass=no_cache,
+    )
+    return {"query": query, "result": answer}
+
+
+_STREAM_END = object()
+
+
+def stream_query_vectorstore(
+    db: VectorStore,
+    query: str,
+    collection_id: str = None,
+) -> Iterator[tuple[str, Any]]:
+    """Answer a query like `query_vectorstore`, step by step
+
+    Args:
+        db (VectorStore): vectorstore
+        query (str): question
+        collection_id (str, optional): id of a stored collection, read
+        locked during the retrieval. Defaults to None.
+
+    Yields:
+        tuple[str, Any]: ("sources", retrieved chunks) first, then
+        ("token", answer token) as the chat model generates them and
+        finally ("result", full answer)
+    """
+    qa = get_retrieval_qa_chain(
+        db,
+        streaming=True,
+        collection_id=collection_id,
+    )
+
+    # the generator runs after the route returned, lock on its own
+    with read_lock(collection_id) if collection_id else nullcontext():
+        docs = qa.retriever.get_relevant_documents(query)
+    yield "sources", [
         {
-            "query": query,
+            "content": doc.page_content,
+            "metadata": doc.metadata,
         }
-    )
-    return result
+        for doc in docs
+    ]
+
+    queue = Queue()
+    outcome = {}
+
+    def run() -> None:
+        try:
+            outcome["result"] = qa.combine_documents_chain.run(
+                input_documents=docs,
+                question=query,
+                callbacks=[QueueCallbackHandler(queue)],
+            )
+        except Exception as err:
+            outcome["error"] = err
+        finally:
+            queue.put(_STREAM_END)
+
+    threading.Thread(target=run, daemon=True).start()
+
+    while (token := queue.get()) is not _STREAM_END:
+        yield "token", token
+
+    if "error" in outcome:
+        raise outcome["error"]
+    yield "result", outcome["result"]
@@ -1,7 +1,9 @@
-from os import getenv
+import asyncio
+import time
+from functools import lru_cache
 from pathlib import Path
+from typing import Any, AsyncIterator
 
-import openai
 from langchain import OpenAI
 from llama_index import (
     Document,
@@ -16,8 +18,26 @@ from llama_index import (
 from llama_index.data_structs import Node
 from llama_index.node_parser import SimpleNodeParser
 from llama_index.response.schema import RESPONSE_TYPE
+from utils.cache_utils import ObjectRegistry
 from utils.config_utils import get_config
+from utils.embedding_utils import text_hash
+from utils.llm_cache_utils import (
+    acached_completion,
+    alookup_completion,
+    astore_completion,
+)
 from utils.logger_utils import get_logger
+from utils.openai_utils import (
+    achat_completion,
+    astream_chat_completion,
+    rate_limited,
+)
+from utils.registry_utils import (
+    CollectionRegistry,
+    dir_size,
+    get_collection_registry,
+)
+from utils.token_utils import count_message_tokens, count_tokens
 
 config = get_config()
 
@@ -36,14 +56,22 @@ def docs2nodes(docs: list[Document]) -> list[Node]:
     return nodes
 
 
-def nodes2index(
-    nodes: list[Node],
-) -> GPTListIndex:
+# LLM predictor, prompt helper and service context only depend on the
+# config, build them once and share them between requests
+_service_context_registry = ObjectRegistry()
+
+
+def _create_service_context(
+    model_name: str,
+    temperature: float,
+) -> ServiceContext:
     # define LLM
     llm_predictor = LLMPredictor(
-        llm=OpenAI(
-            temperature=config.llm.temperature,
-            model_name=config.llm.model_name,
+        llm=rate_limited(
+            OpenAI(
+                temperature=temperature,
+                model_name=model_name,
+            )
         ),
     )
 
@@ -56,9 +84,56 @@ def nodes2index(
     max_chunk_overlap = config.llm.max_chunk_overlap
     prompt_helper = PromptHelper(max_input_size, num_output, max_chunk_overlap)
 
-    service_context = ServiceContext.from_defaults(
+    return ServiceContext.from_defaults(
         llm_predictor=llm_predictor, prompt_helper=prompt_helper
     )
+
+
+def get_service_context() -> ServiceContext:
+    model_name = config.llm.model_name
+    temperature = config.llm.temperature
+    return _service_context_registry.get_or_create(
+        (model_name, temperature),
+        lambda: _create_service_context(model_name, temperature),
+    )
+
+
+REGISTRY_NAMESPACE = "llama_index"
+
+
+def _describe_index(path: Path) -> dict[str, Any]:
+    stat = path.stat()
+    return {
+        "size_bytes": dir_size(path),
+        "created_at": stat.st_ctime,
+        "updated_at": stat.st_mtime,
+    }
+
+
+@lru_cache(maxsize=None)
+def _get_registry() -> CollectionRegistry:
+    registry = get_collection_registry()
+    registry.backfill(
+        REGISTRY_NAMESPACE,
+        config.llm.llama_index.persist_dir,
+        describe=_describe_index,
+    )
+    return registry
+
+
+def _index_path(path: str | Path) -> tuple[Path, str]:
+    """Directory of an index and its registry key, the directory relative
+    to the persist dir, so that every caller registers and looks up an
+    index by the same key"""
+    persist_dir = Path(config.llm.llama_index.persist_dir)
+    path = persist_dir / path
+    return path, path.relative_to(persist_dir).as_posix()
+
+
+def nodes2index(
+    nodes: list[Node],
+) -> GPTListIndex:
+    service_context = get_service_context()
     index = GPTListIndex(nodes, service_context=service_context)
     # index = GPTVectorStoreIndex(nodes, service_context=service_context)
     return index
@@ -67,9 +142,7 @@ def nodes2index(
 def load_index(
     path: str | Path = None,
 ) -> GPT_INDEX_TYPE:
-    persist_dir = Path(config.llm.llama_index.persist_dir)
-    if path:
-        path = persist_dir / path
+    path, _ = _index_path(path)
 
     # rebuild storage context
     storage_context = StorageContext.from_defaults(persist_dir=str(path))
@@ -84,14 +157,18 @@ def save_index(
     index: GPT_INDEX_TYPE,
     path: str | Path = None,
 ) -> None:
-    persist_dir = Path(config.llm.llama_index.persist_dir)
-    if path:
-        path = persist_dir / path
+    path, key = _index_path(path)
     path.parent.mkdir(parents=True, exist_ok=True)
 
     index.storage_context.persist(
         persist_dir=str(path),
     )
+    _get_registry().register(
+        REGISTRY_NAMESPACE,
+        key,
+        documents=len(index.docstore.docs),
+        size_bytes=dir_size(path),
+    )
 
 
 def delete_index(
@@ -105,10 +182,10 @@ def delete_index(
     Returns:
         bool: ok. Return True if successful else False
     """
-    persist_dir = Path(config.llm.llama_index.persist_dir)
-    path = persist_dir / path
+    path, key = _index_path(path)
+    registered = _get_registry().remove(REGISTRY_NAMESPACE, key)
     if not path.exists():
-        return False
+        return registered
 
     for file in path.glob("*"):
         file.unlink(missing_ok=True)
@@ -117,8 +194,7 @@ def delete_index(
 
 
 def list_index() -> list[str]:
-    persist_dir = Path(config.llm.llama_index.persist_dir)
-    return [str(path.name) for path in persist_dir.glob("*") if path.is_dir()]
+    return _get_registry().ids(REGISTRY_NAMESPACE)
 
 
 def query_index(
@@ -130,23 +206,192 @@ def query_index(
 
 
 def check_index_exists(path: Path | str) -> bool:
-    persist_dir = Path(config.llm.llama_index.persist_dir)
-    path = persist_dir / path
-    return path.exists()
-
-
-def run_chatgpt(prompt: str, instruction: str = None) -> str:
-    openai.api_key = getenv("OPENAI_API_KEY")
-
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {
-                "role": "system",
-                "content": instruction or "You are a helpful assistant.",
-            },
-            {"role": "user", "content": prompt},
-        ],
-        temperature=config.llm.temperature,
+    _, key = _index_path(path)
+    return _get_registry().exists(REGISTRY_NAMESPACE, key)
+
+
+CHATGPT_MODEL = "gpt-3.5-turbo"
+DEFAULT_INSTRUCTION = "You are a helpful assistant."
+
+
+def _chatgpt_messages(
+    prompt: str,
+    instruction: str = None,
+) -> list[dict[str, str]]:
+    return [
+        {
+            "role": "system",
+            "content": instruction or DEFAULT_INSTRUCTION,
+        },
+        {"role": "user", "content": prompt},
+    ]
+
+
+def _chatgpt_namespace(instruction: str = None) -> str:
+    # only prompts sent with the same instruction share answers
+    return "chatgpt:%s" % text_hash(instruction or DEFAULT_INSTRUCTION)
+
+
+async def run_chatgpt(
+    prompt: str,
+    instruction: str = None,
+    no_cache: bool = False,
+) -> str:
+    async def complete() -> str:
+        return await achat_completion(
+            _chatgpt_messages(prompt, instruction),
+            model=CHATGPT_MODEL,
+        )
+
+    return await acached_completion(
+        _chatgpt_namespace(instruction),
+        prompt,
+        complete,
+        bypass=no_cache,
     )
-    return response.choices[0].message.content
+
+
+async def stream_chatgpt(
+    prompt: str,
+    instruction: str = None,
+    no_cache: bool = False,
+) -> AsyncIterator[tuple[str, Any]]:
+    """Answer a prompt like `run_chatgpt`, token by token
+
+    Yields:
+        tuple[str, Any]: ("token", answer token) as the model generates
+        them, then ("result", full answer) and ("usage", prompt and
+        completion tokens counted with tiktoken, zero for a cached answer)
+    """
+    namespace = _chatgpt_namespace(instruction)
+    messages = _chatgpt_messages(prompt, instruction)
+
+    answer = await alookup_completion(namespace, prompt, bypass=no_cache)
+    if answer is not None:
+        yield "token", answer
+        yield "result", answer
+        yield "usage", {
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "total_tokens": 0,
+            "cached": True,
+        }
+        return
+
+    tokens = []
+    async for token in astream_chat_completion(
+        messages,
+        model=CHATGPT_MODEL,
+    ):
+        tokens.append(token)
+        yield "token", token
+    answer = "".join(tokens)
+    await astore_completion(namespace, prompt, answer)
+
+    # the streaming API doesn't report usage
+    prompt_tokens = count_message_tokens(messages, CHATGPT_MODEL)
+    completion_tokens = count_tokens(answer, CHATGPT_MODEL)
+    yield "result", answer
+    yield "usage", {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "cached": False,
+    }
+
+
+async def stream_chatgpt_batch(
+    items: list[tuple[str, str | None]],
+    no_cache: bool = False,
+    max_concurrency: int = None,
+) -> AsyncIterator[tuple[str, Any]]:
+    """Answer many prompts like `run_chatgpt`, at most `max_concurrency`
+    at a time
+
+    Identical items are answered once. Closing the iteration cancels the
+    completions still running or waiting.
+
+    Args:
+        items (list[tuple[str, str | None]]): prompts and instructions
+        no_cache (bool, optional): skip the semantic cache lookups.
+        Defaults to False.
+
+        max_concurrency (int, optional): completions in flight, capped at
+        config.llm.batch.max_concurrency. Defaults to the cap.
+
+    Yields:
+        tuple[str, Any]: ("result", item result) as items complete, with
+        the index of the item, its answer or error and timings, then
+        ("done", batch summary)
+    """
+    start = time.perf_counter()
+    limit = config.llm.batch.max_concurrency
+    semaphore = asyncio.Semaphore(max(1, min(max_concurrency or limit, limit)))
+
+    indexes: dict[tuple[str, str], list[int]] = {}
+    for i, (prompt, instruction) in enumerate(items):
+        key = (prompt, instruction or DEFAULT_INSTRUCTION)
+        indexes.setdefault(key, []).append(i)
+
+    async def run(key: tuple[str, str]) -> dict[str, Any]:
+        queued = time.perf_counter()
+        async with semaphore:
+            started = time.perf_counter()
+            result, error = None, None
+            try:
+                result = await run_chatgpt(*key, no_cache=no_cache)
+            except Exception as err:
+                error = str(err)
+        return {
+            "key": key,
+            "result": result,
+            "error": error,
+            "queued_seconds": round(started - queued, 3),
+            "elapsed_seconds": round(time.perf_counter() - started, 3),
+        }
+
+    errors = 0
+    tasks = [asyncio.ensure_future(run(key)) for key in indexes]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            outcome = await next_done
+            key = outcome.pop("key")
+            for n, i in enumerate(indexes[key]):
+                errors += outcome["error"] is not None
+                # later copies of an item reuse the answer of the first
+                yield "result", {"index": i, "deduplicated": n > 0, **outcome}
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    yield "done", {
+        "items": len(items),
+        "unique_items": len(indexes),
+        "errors": errors,
+        "elapsed_seconds": round(time.perf_counter() - start, 3),
+    }
+
+
+async def run_chatgpt_batch(
+    items: list[tuple[str, str | None]],
+    no_cache: bool = False,
+    max_concurrency: int = None,
+) -> dict[str, Any]:
+    """Answer many prompts, see `stream_chatgpt_batch`
+
+    Returns:
+        dict[str, Any]: batch summary, with the item results in the order
+        of `items`
+    """
+    results = [None] * len(items)
+    summary = {}
+    async for event, data in stream_chatgpt_batch(
+        items,
+        no_cache=no_cache,
+        max_concurrency=max_concurrency,
+    ):
+        if event == "result":
+            results[data["index"]] = data
+        else:
+            summary = data
+    return {**summary, "results": results}
@@ -0,0 +1,286 @@
+import json
+import threading
+import time
+from pathlib import Path
+from typing import Any, Awaitable, Callable
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+from utils.async_utils import run_sync
+from utils.config_utils import get_config
+from utils.embedding_utils import create_embeddings
+from utils.logger_utils import get_logger
+
+config = get_config()
+
+logger = get_logger()
+
+
+class SemanticCache:
+    """Semantic cache of LLM answers backed by gptcache
+
+    Prompts are embedded and near-duplicates of a cached prompt, by cosine
+    similarity, are answered from the cache. Answers are tagged with a
+    namespace so that the same question asked in different contexts (e.g.
+    to different collections) never shares an answer.
+
+    Args:
+        data_dir (str): directory of the gptcache sqlite and faiss files
+        embeddings (Embeddings): embeddings of the prompts, they must be
+        L2-normalized
+
+        similarity_threshold (float, optional): minimum cosine similarity
+        of a hit. Defaults to 0.95.
+
+        ttl_seconds (float, optional): age after which an answer is stale.
+        Defaults to None (never).
+
+        max_size (int, optional): maximum number of cached answers, least
+        recently used ones are evicted. Defaults to 1000.
+
+        clean_size (int, optional): answers evicted at once when the cache
+        is full. Defaults to a fifth of `max_size`.
+
+        top_k (int, optional): candidates looked at per lookup.
+        Defaults to 5.
+    """
+
+    def __init__(
+        self,
+        data_dir: str,
+        embeddings: Embeddings,
+        similarity_threshold: float = 0.95,
+        ttl_seconds: float = None,
+        max_size: int = 1000,
+        clean_size: int = None,
+        top_k: int = 5,
+    ) -> None:
+        from gptcache.manager import manager_factory
+
+        self.embeddings = embeddings
+        self.ttl_seconds = ttl_seconds
+        self.top_k = top_k
+        # squared L2 distance of unit vectors = 2 - 2 * cosine
+        self.max_distance = 2 - 2 * similarity_threshold
+
+        Path(data_dir).mkdir(parents=True, exist_ok=True)
+        dimension = len(embeddings.embed_query("dimension"))
+        self._data_manager = manager_factory(
+            "sqlite,faiss",
+            data_dir=data_dir,
+            max_size=max_size,
+            # without it gptcache fails every save once full
+            clean_size=clean_size or max(1, int(max_size * 0.2)),
+            eviction="LRU",
+            vector_params={"dimension": dimension, "top_k": top_k},
+        )
+        # gptcache's sqlite and faiss stores are not thread-safe
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+
+    def _embed(self, prompt: str) -> np.ndarray:
+        return np.asarray(self.embeddings.embed_query(prompt), dtype="float32")
+
+    def _lookup(self, namespace: str, embedding: np.ndarray) -> str | None:
+        data_manager = self._data_manager
+        now = time.time()
+        matches, expired = [], []
+        for distance, id_ in (
+            data_manager.search(embedding, top_k=self.top_k) or []
+        ):
+            if distance > self.max_distance:
+                continue
+            cache_data = data_manager.get_scalar_data((distance, id_))
+            if cache_data is None:
+                continue
+            entry = json.loads(cache_data.answers[0].answer)
+            if (
+                self.ttl_seconds
+                and now - entry["created_at"] > self.ttl_seconds
+            ):
+                expired.append(id_)
+            elif entry["namespace"] == namespace:
+                matches.append((entry["created_at"], id_, entry["answer"]))
+
+        if expired:
+            # stale answers would otherwise only leave by LRU eviction
+            for id_ in expired:
+                data_manager.eviction_base._cache.pop(id_, None)
+            data_manager._clear(expired)
+        if not matches:
+            return None
+
+        # the newest answer wins, e.g. the one stored by a bypass over the
+        # answer it refreshed. Only the answer served is marked as used
+        _, id_, answer = max(matches)
+        data_manager.hit_cache_callback((None, id_))
+        return answer
+
+    def get(self, namespace: str, prompt: str) -> str | None:
+        embedding = self._embed(prompt)
+        with self._lock:
+            answer = self._lookup(namespace, embedding)
+            if answer is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return answer
+
+    def record_bypass(self) -> None:
+        with self._lock:
+            self.bypasses += 1
+
+    def put(self, namespace: str, prompt: str, answer: str) -> None:
+        entry = {
+            "namespace": namespace,
+            "answer": answer,
+            "created_at": time.time(),
+        }
+        embedding = self._embed(prompt)
+        with self._lock:
+            # the gptcache adapter only logs a failed save as a warning
+            self._data_manager.save(prompt, json.dumps(entry), embedding)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypasses": self.bypasses,
+            }
+
+
+_semantic_cache: SemanticCache | None = None
+_semantic_cache_lock = threading.Lock()
+
+
+def get_semantic_cache() -> SemanticCache | None:
+    """Shared semantic cache, None if disabled in the config"""
+    global _semantic_cache
+
+    cache_config = config.llm.semantic_cache
+    if not cache_config.enabled:
+        return None
+
+    with _semantic_cache_lock:
+        if _semantic_cache is None:
+            provider = cache_config.embedding_provider
+            embeddings, _ = create_embeddings(
+                provider,
+                **config.llm.langchain.embedding.providers[provider],
+            )
+            _semantic_cache = SemanticCache(
+                data_dir=cache_config.data_dir,
+                embeddings=embeddings,
+                similarity_threshold=cache_config.similarity_threshold,
+                ttl_seconds=cache_config.ttl_seconds,
+                max_size=cache_config.max_size,
+            )
+        return _semantic_cache
+
+
+def get_semantic_cache_stats() -> dict[str, Any] | None:
+    if _semantic_cache is None:
+        return None
+    return _semantic_cache.stats()
+
+
+def cached_completion(
+    namespace: str,
+    prompt: str,
+    complete: Callable[[], str],
+    bypass: bool = False,
+) -> str:
+    """Answer from the semantic cache, or complete and cache the answer
+
+    Args:
+        namespace (str): context of the prompt, only answers cached in the
+        same namespace are reused
+
+        prompt (str): text compared for similarity
+        complete (Callable[[], str]): computes the answer on a miss
+        bypass (bool, optional): skip the lookup, the fresh answer is still
+        cached. Defaults to False.
+
+    Returns:
+        str: answer
+    """
+    cache = get_semantic_cache()
+    if cache is None:
+        return complete()
+
+    if bypass:
+        cache.record_bypass()
+    else:
+        try:
+            answer = cache.get(namespace, prompt)
+            if answer is not None:
+                logger.info("Semantic cache hit in %s" % namespace)
+                return answer
+        except Exception as err:
+            # the cache must never make a request fail
+            logger.exception(err)
+
+    answer = complete()
+
+    try:
+        cache.put(namespace, prompt, answer)
+    except Exception as err:
+        logger.exception(err)
+    return answer
+
+
+async def acached_completion(
+    namespace: str,
+    prompt: str,
+    complete: Callable[[], Awaitable[str]],
+    bypass: bool = False,
+) -> str:
+    """Async `cached_completion`, `complete` is awaited on the event loop
+
+    Cache lookups embed the prompt and take the cache lock, they run on
+    the threadpool, only while the cache is enabled.
+    """
+    answer = await alookup_completion(namespace, prompt, bypass=bypass)
+    if answer is None:
+        answer = await complete()
+        await astore_completion(namespace, prompt, answer)
+    return answer
+
+
+async def alookup_completion(
+    namespace: str,
+    prompt: str,
+    bypass: bool = False,
+) -> str | None:
+    """Cached answer of a prompt, None on a miss or if the cache is
+    disabled. See `cached_completion`"""
+    cache = get_semantic_cache()
+    if cache is None:
+        return None
+
+    if bypass:
+        cache.record_bypass()
+        return None
+    try:
+        answer = await run_sync(cache.get, namespace, prompt)
+        if answer is not None:
+            logger.info("Semantic cache hit in %s" % namespace)
+        return answer
+    except Exception as err:
+        logger.exception(err)
+        return None
+
+
+async def astore_completion(namespace: str, prompt: str, answer: str) -> None:
+    cache = get_semantic_cache()
+    if cache is None:
+        return
+
+    try:
+        await run_sync(cache.put, namespace, prompt, answer)
+    except Exception as err:
+        logger.exception(err)
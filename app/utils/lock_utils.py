@@ -0,0 +1,174 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Hashable, Iterator
+
+
+class RWLock:
+    """Reader/writer lock preferring writers
+
+    Any number of readers hold the lock together, a writer holds it alone.
+    Once a writer waits, new readers queue behind it so a steady flow of
+    queries can't starve writes. The writing thread may take the write or
+    read lock again, a reader must not upgrade to writing.
+    """
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer: int | None = None
+        self._writer_depth = 0
+        self._writers_waiting = 0
+
+    def acquire_read(self) -> None:
+        with self._cond:
+            if self._writer != threading.get_ident():
+                while self._writer is not None or self._writers_waiting:
+                    self._cond.wait()
+            self._readers += 1
+
+    def release_read(self) -> None:
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self) -> None:
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._writer_depth += 1
+                return
+
+            self._writers_waiting += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writer = me
+            self._writer_depth = 1
+
+    def release_write(self) -> None:
+        with self._cond:
+            self._writer_depth -= 1
+            if not self._writer_depth:
+                self._writer = None
+                self._cond.notify_all()
+
+
+class _LockStats:
+    def __init__(self) -> None:
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def record(self, wait: float, contended: bool) -> None:
+        self.acquisitions += 1
+        self.contended += contended
+        self.wait_seconds += wait
+        self.max_wait_seconds = max(self.max_wait_seconds, wait)
+
+    def dict(self) -> dict[str, Any]:
+        return {
+            "acquisitions": self.acquisitions,
+            "contended": self.contended,
+            "wait_seconds": round(self.wait_seconds, 3),
+            "max_wait_seconds": round(self.max_wait_seconds, 3),
+        }
+
+
+class RWLockManager:
+    """Reader/writer locks by key, with wait time metrics
+
+    Locks are created on first use and dropped once nobody holds or waits
+    for them, so the number of keys seen doesn't matter.
+
+    Args:
+        top_keys (int, optional): most contended keys reported by `stats`.
+        Defaults to 10.
+    """
+
+    # waits shorter than this are the cost of the lock, not contention
+    CONTENDED_SECONDS = 0.001
+
+    def __init__(self, top_keys: int = 10) -> None:
+        self.top_keys = top_keys
+        self._locks: dict[Hashable, tuple[RWLock, list[int]]] = {}
+        self._lock = threading.Lock()
+        self._stats = {"read": _LockStats(), "write": _LockStats()}
+        self._key_wait_seconds: dict[Hashable, float] = {}
+
+    def _checkout(self, key: Hashable) -> RWLock:
+        with self._lock:
+            lock, users = self._locks.setdefault(key, (RWLock(), [0]))
+            users[0] += 1
+        return lock
+
+    def _checkin(self, key: Hashable) -> None:
+        with self._lock:
+            # users hold or wait for the lock, none left means it's free
+            users = self._locks[key][1]
+            users[0] -= 1
+            if not users[0]:
+                del self._locks[key]
+
+    def _record(self, mode: str, key: Hashable, wait: float) -> None:
+        contended = wait >= self.CONTENDED_SECONDS
+        with self._lock:
+            self._stats[mode].record(wait, contended)
+            if contended:
+                self._key_wait_seconds[key] = (
+                    self._key_wait_seconds.get(key, 0.0) + wait
+                )
+                if len(self._key_wait_seconds) > 100 * self.top_keys:
+                    self._key_wait_seconds = dict(self._top())
+
+    def _top(self) -> list[tuple[Hashable, float]]:
+        return sorted(
+            self._key_wait_seconds.items(),
+            key=lambda item: item[1],
+            reverse=True,
+        )[: self.top_keys]
+
+    @contextmanager
+    def read(self, key: Hashable) -> Iterator[None]:
+        lock = self._checkout(key)
+        try:
+            start = time.perf_counter()
+            lock.acquire_read()
+            self._record("read", key, time.perf_counter() - start)
+            try:
+                yield
+            finally:
+                lock.release_read()
+        finally:
+            self._checkin(key)
+
+    @contextmanager
+    def write(self, key: Hashable) -> Iterator[None]:
+        lock = self._checkout(key)
+        try:
+            start = time.perf_counter()
+            lock.acquire_write()
+            self._record("write", key, time.perf_counter() - start)
+            try:
+                yield
+            finally:
+                lock.release_write()
+        finally:
+            self._checkin(key)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            top = self._top()
+            return {
+                "locks": len(self._locks),
+                "read": self._stats["read"].dict(),
+                "write": self._stats["write"].dict(),
+                "most_contended": [
+                    {"key": str(key), "wait_seconds": round(wait, 3)}
+                    for key, wait in top
+                ],
+            }
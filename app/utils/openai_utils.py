@@ -0,0 +1,353 @@
+import asyncio
+import json
+from os import getenv
+from typing import Any, AsyncIterator, TypeVar
+
+import aiohttp
+import openai
+from tenacity import (
+    AsyncRetrying,
+    RetryCallState,
+    Retrying,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+from utils.cache_utils import ObjectRegistry
+from utils.config_utils import get_config
+from utils.logger_utils import get_logger
+from utils.rate_limit_utils import RateLimiter
+from utils.token_utils import count_message_tokens, count_tokens
+
+config = get_config()
+
+logger = get_logger()
+
+_session: aiohttp.ClientSession | None = None
+_session_loop: asyncio.AbstractEventLoop | None = None
+
+RETRYABLE_ERRORS = (
+    openai.error.Timeout,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+)
+
+_rate_limiter_registry = ObjectRegistry()
+
+T = TypeVar("T")
+
+
+def get_aiohttp_session() -> aiohttp.ClientSession:
+    """Session shared by the async OpenAI calls of the running event loop
+
+    Its connection pool keeps connections to the API alive between calls,
+    so concurrent completions don't each pay a TCP and TLS handshake.
+    """
+    global _session, _session_loop
+
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=config.llm.openai.max_connections,
+                ttl_dns_cache=300,
+            ),
+            timeout=aiohttp.ClientTimeout(
+                total=config.llm.openai.timeout_seconds
+            ),
+        )
+        _session_loop = loop
+    return _session
+
+
+async def close_aiohttp_session() -> None:
+    global _session
+
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+def get_rate_limiter(model: str = None) -> RateLimiter:
+    """Budgets of a model, shared by every call to it in the process
+
+    Models without limits in config.llm.rate_limit.limits share the
+    default ones.
+    """
+    limits = config.llm.rate_limit.limits
+    key = model if model in limits else "default"
+    return _rate_limiter_registry.get_or_create(
+        key,
+        lambda: RateLimiter(
+            requests_per_minute=limits[key].requests_per_minute,
+            tokens_per_minute=limits[key].tokens_per_minute,
+            burst_seconds=config.llm.rate_limit.burst_seconds,
+        ),
+    )
+
+
+def get_rate_limit_stats() -> dict:
+    return {
+        key: limiter.stats() for key, limiter in _rate_limiter_registry.items()
+    }
+
+
+def _prompt_tokens(params: dict) -> int:
+    model = params.get("model") or params.get("engine")
+    if "messages" in params:
+        return count_message_tokens(params["messages"], model)
+
+    inputs = params.get("prompt", params.get("input")) or ""
+    if isinstance(inputs, str) or isinstance(inputs[0], int):
+        inputs = [inputs]
+    # langchain embeddings send token ids
+    return sum(
+        len(text) if isinstance(text, list) else count_tokens(text, model)
+        for text in inputs
+    )
+
+
+def _completion_tokens(params: dict) -> int:
+    if "input" in params:
+        return 0
+
+    # -1 is "as many as fit" for langchain
+    max_tokens = params.get("max_tokens")
+    if not max_tokens or max_tokens < 0:
+        max_tokens = config.llm.num_output
+    return max_tokens * (params.get("n") or 1)
+
+
+def _retry_options(limiter: RateLimiter) -> dict:
+    settings = config.llm.rate_limit
+
+    def before_sleep(state: RetryCallState) -> None:
+        error = state.outcome.exception()
+        if isinstance(error, openai.error.RateLimitError):
+            limiter.throttle(_retry_after(error))
+        limiter.record_retry()
+        logger.warning(
+            "OpenAI request failed, retrying in %.1fs: %s"
+            % (state.next_action.sleep, error)
+        )
+
+    return {
+        "reraise": True,
+        "stop": stop_after_attempt(settings.max_attempts),
+        "wait": wait_random_exponential(
+            multiplier=settings.min_backoff_seconds,
+            min=settings.min_backoff_seconds,
+            max=settings.max_backoff_seconds,
+        ),
+        "retry": retry_if_exception_type(RETRYABLE_ERRORS),
+        "before_sleep": before_sleep,
+    }
+
+
+def _retry_after(error: openai.error.OpenAIError) -> float:
+    headers = {
+        name.lower(): value for name, value in (error.headers or {}).items()
+    }
+    try:
+        return float(headers["retry-after"])
+    except (KeyError, ValueError):
+        return config.llm.rate_limit.min_backoff_seconds
+
+
+def _refund_unused(
+    limiter: RateLimiter,
+    estimated: int,
+    response: Any,
+) -> None:
+    usage = response.get("usage") if isinstance(response, dict) else None
+    if usage:
+        limiter.refund(estimated - usage["total_tokens"])
+
+
+class RateLimitedClient:
+    """openai API resource, e.g. openai.ChatCompletion, whose calls wait for
+    the rate limits of their model and are retried with jittered
+    exponential backoff
+
+    Args:
+        client (Any): API resource with create and acreate
+    """
+
+    def __init__(self, client: Any) -> None:
+        self.client = client
+
+    def create(self, **params: Any) -> Any:
+        limiter = get_rate_limiter(params.get("model") or params.get("engine"))
+        tokens = _prompt_tokens(params) + _completion_tokens(params)
+        for attempt in Retrying(**_retry_options(limiter)):
+            with attempt:
+                limiter.acquire(tokens)
+                response = self.client.create(**params)
+
+        _refund_unused(limiter, tokens, response)
+        return response
+
+    async def acreate(self, **params: Any) -> Any:
+        limiter = get_rate_limiter(params.get("model") or params.get("engine"))
+        tokens = _prompt_tokens(params) + _completion_tokens(params)
+        async for attempt in AsyncRetrying(**_retry_options(limiter)):
+            with attempt:
+                await limiter.aacquire(tokens)
+                response = await self.client.acreate(**params)
+
+        _refund_unused(limiter, tokens, response)
+        return response
+
+
+def rate_limited(model: T) -> T:
+    """Send the requests of a langchain OpenAI LLM, chat model or
+    embeddings through the rate limiters of the process
+
+    Their own retries are turned off, `RateLimitedClient` retries with
+    the settings of config.llm.rate_limit.
+    """
+    model.client = RateLimitedClient(model.client)
+    model.max_retries = 1
+    return model
+
+
+_chat_completion = RateLimitedClient(openai.ChatCompletion)
+
+
+async def achat_completion(
+    messages: list[dict[str, str]],
+    model: str = None,
+    temperature: float = None,
+    **kwargs: Any,
+) -> str:
+    """Chat completion awaited on the event loop, without a worker thread
+
+    Args:
+        messages (list[dict[str, str]]): chat messages, with role and
+        content
+
+        model (str, optional): chat model. Defaults to config.llm.model_name.
+        temperature (float, optional): sampling temperature.
+        Defaults to config.llm.temperature.
+
+    Returns:
+        str: content of the first choice
+    """
+    if temperature is None:
+        temperature = config.llm.temperature
+
+    # openai reads the session from a context variable, setting it here
+    # only affects the current task
+    openai.aiosession.set(get_aiohttp_session())
+    response = await _chat_completion.acreate(
+        model=model or config.llm.model_name,
+        messages=messages,
+        temperature=temperature,
+        # per call, setting openai.api_key would be global
+        api_key=getenv("OPENAI_API_KEY"),
+        **kwargs,
+    )
+    return response.choices[0].message.content
+
+
+async def astream_chat_completion(
+    messages: list[dict[str, str]],
+    model: str = None,
+    temperature: float = None,
+    **kwargs: Any,
+) -> AsyncIterator[str]:
+    """Tokens of a chat completion, as the model generates them
+
+    Arguments are the ones of `achat_completion`. Closing or cancelling
+    the iteration, e.g. when the client of a streamed response leaves,
+    closes the upstream connection, which stops the generation.
+
+    The API is requested directly, the openai package never closes the
+    HTTP response of a stream.
+    """
+    if temperature is None:
+        temperature = config.llm.temperature
+
+    params = {
+        "model": model or config.llm.model_name,
+        "messages": messages,
+        "temperature": temperature,
+        "stream": True,
+        **kwargs,
+    }
+    headers = {"Authorization": "Bearer %s" % getenv("OPENAI_API_KEY")}
+    if openai.organization:
+        headers["OpenAI-Organization"] = openai.organization
+
+    limiter = get_rate_limiter(params["model"])
+    completion_tokens = _completion_tokens(params)
+    tokens = _prompt_tokens(params) + completion_tokens
+    # only connecting is retried, not a stream that broke halfway
+    async for attempt in AsyncRetrying(**_retry_options(limiter)):
+        with attempt:
+            await limiter.aacquire(tokens)
+            response = await _post(
+                "%s/chat/completions" % openai.api_base,
+                json=params,
+                headers=headers,
+            )
+
+    generated = 0
+    try:
+        async for line in response.content:
+            if not line.startswith(b"data: "):
+                continue
+            data = line[len(b"data: ") :].strip()
+            if data == b"[DONE]":
+                break
+            chunk = json.loads(data)
+            if not chunk.get("choices"):
+                continue
+            token = chunk["choices"][0].get("delta", {}).get("content")
+            if token:
+                generated += 1
+                yield token
+    finally:
+        # before the end of the response, this closes the connection
+        # instead of returning it to the pool
+        response.release()
+        # a chunk is about a token
+        limiter.refund(completion_tokens - generated)
+
+
+async def _post(url: str, **kwargs: Any) -> aiohttp.ClientResponse:
+    try:
+        response = await get_aiohttp_session().post(url, **kwargs)
+    except asyncio.TimeoutError as err:
+        raise openai.error.Timeout("request timed out") from err
+    except aiohttp.ClientError as err:
+        raise openai.error.APIConnectionError(str(err)) from err
+
+    if response.status != 200:
+        body = await response.text()
+        response.release()
+        raise _api_error(response.status, body, dict(response.headers))
+    return response
+
+
+def _api_error(
+    status: int,
+    body: str,
+    headers: dict = None,
+) -> openai.error.OpenAIError:
+    try:
+        message = json.loads(body)["error"]["message"]
+    except (ValueError, KeyError, TypeError):
+        message = body
+
+    options = {"http_body": body, "http_status": status, "headers": headers}
+    # client errors are not retried
+    if status == 429:
+        return openai.error.RateLimitError(message, **options)
+    if status == 401:
+        return openai.error.AuthenticationError(message, **options)
+    if status in (400, 404):
+        return openai.error.InvalidRequestError(message, None, **options)
+    return openai.error.APIError(message, **options)
@@ -0,0 +1,163 @@
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Hashable
+
+from utils.logger_utils import get_logger
+
+logger = get_logger()
+
+PersistFunc = Callable[[Hashable, Any], None]
+
+
+@dataclass
+class _DirtyEntry:
+    store: Any
+    pending: int
+    dirty_since: float
+
+
+class WriteBehindPersister:
+    """Defer and batch the persistence of modified stores
+
+    Instead of persisting a store after every write, writes mark it dirty
+    and it is persisted once `flush_interval` seconds after its first
+    unpersisted write, or as soon as `max_pending` items are waiting,
+    whichever comes first.
+
+    Args:
+        persist (PersistFunc): called with (key, store) to persist a store
+        flush_interval (float, optional): maximum seconds a write stays
+        unpersisted. Defaults to 30.
+
+        max_pending (int, optional): pending items that trigger an
+        immediate flush. Defaults to 500.
+    """
+
+    def __init__(
+        self,
+        persist: PersistFunc,
+        flush_interval: float = 30,
+        max_pending: int = 500,
+    ) -> None:
+        self._persist = persist
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self._dirty: dict[Hashable, _DirtyEntry] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+        self.flushes = 0
+
+    def mark_dirty(self, key: Hashable, store: Any, pending: int = 1) -> None:
+        with self._lock:
+            entry = self._dirty.get(key)
+            if entry is None or entry.store is not store:
+                entry = _DirtyEntry(store, 0, time.monotonic())
+                self._dirty[key] = entry
+            entry.pending += pending
+            full = entry.pending >= self.max_pending
+
+        if full:
+            self.flush(key)
+
+    def flush(self, key: Hashable) -> bool:
+        """Persist a store now if it has pending writes
+
+        Returns:
+            bool: True if the store was dirty
+        """
+        with self._lock:
+            entry = self._dirty.get(key)
+            if entry is None:
+                return False
+            pending = entry.pending
+
+        # the entry stays until persisted so `pending_store` keeps finding
+        # the store, on failure it stays dirty and the next flush retries
+        self._persist(key, entry.store)
+        self.flushes += 1
+
+        with self._lock:
+            if self._dirty.get(key) is entry:
+                entry.pending -= pending
+                if entry.pending > 0:
+                    # written to while persisting
+                    entry.dirty_since = time.monotonic()
+                else:
+                    del self._dirty[key]
+        return True
+
+    def flush_all(self) -> int:
+        """Persist every dirty store
+
+        Returns:
+            int: number of stores persisted
+        """
+        with self._lock:
+            keys = list(self._dirty)
+
+        flushed = 0
+        for key in keys:
+            try:
+                flushed += self.flush(key)
+            except Exception as err:
+                logger.exception(err)
+        return flushed
+
+    def pending_store(self, key: Hashable) -> Any | None:
+        """Store with unpersisted writes under a key, if any"""
+        with self._lock:
+            entry = self._dirty.get(key)
+        return entry.store if entry else None
+
+    def discard(self, key: Hashable) -> None:
+        """Forget pending writes, e.g. of a deleted store"""
+        with self._lock:
+            self._dirty.pop(key, None)
+
+    def _flush_expired(self) -> None:
+        deadline = time.monotonic() - self.flush_interval
+        with self._lock:
+            keys = [
+                key
+                for key, entry in self._dirty.items()
+                if entry.dirty_since <= deadline
+            ]
+
+        for key in keys:
+            try:
+                self.flush(key)
+            except Exception as err:
+                logger.exception(err)
+
+    def _run(self) -> None:
+        # check a few times per interval so no write waits much longer
+        period = max(self.flush_interval / 4, 0.1)
+        while not self._stop.wait(period):
+            self._flush_expired()
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the background flushes and persist everything pending"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.flush_all()
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "dirty": len(self._dirty),
+                "pending": sum(e.pending for e in self._dirty.values()),
+                "flushes": self.flushes,
+            }
@@ -0,0 +1,179 @@
+import asyncio
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+
+class RateLimiter:
+    """Requests and tokens per minute budgets shared by the callers of an API
+
+    Both budgets are token buckets refilled continuously, holding at most
+    `burst_seconds` of their rate. A caller reserves its request and tokens
+    right away, letting the buckets go into debt, then sleeps until the
+    debt is paid back. Callers are served in the order they arrive, a large
+    request isn't overtaken forever by small ones and nobody polls.
+
+    Args:
+        requests_per_minute (float): 0 for no limit
+        tokens_per_minute (float): 0 for no limit
+        burst_seconds (float, optional): budget that can be spent at once,
+        in seconds of the rates. Defaults to 10.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float,
+        tokens_per_minute: float,
+        burst_seconds: float = 10.0,
+    ) -> None:
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+
+        self._request_rate = requests_per_minute / 60
+        self._token_rate = tokens_per_minute / 60
+        self._request_capacity = max(1.0, self._request_rate * burst_seconds)
+        self._token_capacity = max(1.0, self._token_rate * burst_seconds)
+        self._requests = self._request_capacity
+        self._tokens = self._token_capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+        self._queued = 0
+        self._max_queued = 0
+        self._acquired = 0
+        self._acquired_tokens = 0
+        self._waits = 0
+        self._wait_seconds = 0.0
+        self._max_wait_seconds = 0.0
+        self._throttled = 0
+        self._retries = 0
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(
+            self._request_capacity,
+            self._requests + elapsed * self._request_rate,
+        )
+        self._tokens = min(
+            self._token_capacity,
+            self._tokens + elapsed * self._token_rate,
+        )
+
+    def _reserve(self, tokens: int) -> float:
+        """Take the budget of a request, returns when it may be sent"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+
+            deadline = max(now, self._paused_until)
+            if self._request_rate:
+                self._requests -= 1
+                deadline = max(
+                    deadline, now - self._requests / self._request_rate
+                )
+            if self._token_rate and tokens:
+                self._tokens -= tokens
+                deadline = max(deadline, now - self._tokens / self._token_rate)
+
+            self._acquired += 1
+            self._acquired_tokens += tokens
+            return deadline
+
+    def _delay(self, deadline: float) -> float:
+        # a 429 received meanwhile pauses the callers already queued too
+        return max(deadline, self._paused_until) - time.monotonic()
+
+    @contextmanager
+    def _queue(self) -> Iterator[None]:
+        start = time.monotonic()
+        with self._lock:
+            self._queued += 1
+            self._max_queued = max(self._max_queued, self._queued)
+        try:
+            yield
+        finally:
+            waited = time.monotonic() - start
+            with self._lock:
+                self._queued -= 1
+                self._waits += 1
+                self._wait_seconds += waited
+                self._max_wait_seconds = max(self._max_wait_seconds, waited)
+
+    def acquire(self, tokens: int = 0) -> None:
+        """Wait until a request of `tokens` fits in the budgets"""
+        deadline = self._reserve(tokens)
+        if self._delay(deadline) <= 0:
+            return
+
+        with self._queue():
+            while (delay := self._delay(deadline)) > 0:
+                time.sleep(delay)
+
+    async def aacquire(self, tokens: int = 0) -> None:
+        """`acquire` sleeping on the event loop"""
+        deadline = self._reserve(tokens)
+        if self._delay(deadline) <= 0:
+            return
+
+        with self._queue():
+            try:
+                while (delay := self._delay(deadline)) > 0:
+                    await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                # the request won't be sent, let the next callers have it
+                self.refund(tokens, requests=1)
+                raise
+
+    def refund(self, tokens: int, requests: int = 0) -> None:
+        """Give back budget taken but not used, e.g. when the completion
+        was shorter than its estimate. Negative values take more"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._requests = min(
+                self._request_capacity, self._requests + requests
+            )
+            self._tokens = min(self._token_capacity, self._tokens + tokens)
+
+    def throttle(self, seconds: float) -> None:
+        """Pause every caller after the API answered 429
+
+        The buckets are emptied, the limits of the API are lower than the
+        configured ones or they are shared with another process.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._requests = min(self._requests, 0.0)
+            self._tokens = min(self._tokens, 0.0)
+            self._paused_until = max(self._paused_until, now + seconds)
+            self._throttled += 1
+
+    def record_retry(self) -> None:
+        with self._lock:
+            self._retries += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._refill(time.monotonic())
+            return {
+                "requests_per_minute": self.requests_per_minute,
+                "tokens_per_minute": self.tokens_per_minute,
+                "available_requests": int(max(self._requests, 0)),
+                "available_tokens": int(max(self._tokens, 0)),
+                "queue_depth": self._queued,
+                "max_queue_depth": self._max_queued,
+                "requests": self._acquired,
+                "tokens": self._acquired_tokens,
+                "waits": self._waits,
+                "wait_seconds": round(self._wait_seconds, 3),
+                "average_wait_seconds": round(
+                    self._wait_seconds / self._waits if self._waits else 0.0,
+                    3,
+                ),
+                "max_wait_seconds": round(self._max_wait_seconds, 3),
+                "throttled": self._throttled,
+                "retries": self._retries,
+            }
@@ -0,0 +1,288 @@
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Callable
+
+from utils.config_utils import get_config
+from utils.logger_utils import get_logger
+
+config = get_config()
+
+logger = get_logger()
+
+COLUMNS = (
+    "collection_id",
+    "documents",
+    "chunks",
+    "embedding_provider",
+    "embedding_model",
+    "size_bytes",
+    "created_at",
+    "updated_at",
+    "last_queried_at",
+    "build_seconds",
+)
+
+DescribeFunc = Callable[[Path], dict[str, Any]]
+
+
+class CollectionRegistry:
+    """Metadata of stored collections in a local SQLite file
+
+    Replaces scanning the storage directories: existence checks and
+    listings are primary key lookups, and the counts, sizes and timings
+    recorded by the indexing paths are kept for capacity planning.
+    Collections of different stores (langchain, llama_index) are kept
+    apart by namespace.
+
+    Args:
+        path (str | Path): path to the SQLite file
+    """
+
+    def __init__(self, path: str | Path) -> None:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS collections (
+                namespace TEXT NOT NULL,
+                collection_id TEXT NOT NULL,
+                documents INTEGER,
+                chunks INTEGER,
+                embedding_provider TEXT,
+                embedding_model TEXT,
+                size_bytes INTEGER,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                last_queried_at REAL,
+                build_seconds REAL,
+                PRIMARY KEY (namespace, collection_id)
+            )
+            """
+        )
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS backfills (
+                namespace TEXT PRIMARY KEY,
+                backfilled_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+
+    def register(
+        self,
+        namespace: str,
+        collection_id: str,
+        documents: int = None,
+        chunks: int = None,
+        embedding_provider: str = None,
+        embedding_model: str = None,
+        size_bytes: int = None,
+        build_seconds: float = None,
+        created_at: float = None,
+        updated_at: float = None,
+    ) -> None:
+        """Record a newly built collection, replacing any previous entry"""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO collections "
+                "(namespace, collection_id, documents, chunks, "
+                "embedding_provider, embedding_model, size_bytes, "
+                "created_at, updated_at, build_seconds) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    namespace,
+                    collection_id,
+                    documents,
+                    chunks,
+                    embedding_provider,
+                    embedding_model,
+                    size_bytes,
+                    created_at or now,
+                    updated_at or now,
+                    build_seconds,
+                ),
+            )
+
+    def record_update(
+        self,
+        namespace: str,
+        collection_id: str,
+        documents: int = 0,
+        chunks: int = 0,
+        size_bytes: int = None,
+    ) -> None:
+        """Apply document and chunk count deltas of a modification
+
+        The deltas are applied in SQL so concurrent updates don't lose
+        each other's counts.
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE collections SET "
+                "documents = documents + ?, chunks = chunks + ?, "
+                "size_bytes = COALESCE(?, size_bytes), updated_at = ? "
+                "WHERE namespace = ? AND collection_id = ?",
+                (
+                    documents,
+                    chunks,
+                    size_bytes,
+                    time.time(),
+                    namespace,
+                    collection_id,
+                ),
+            )
+
+    def set_size(
+        self,
+        namespace: str,
+        collection_id: str,
+        size_bytes: int,
+    ) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE collections SET size_bytes = ? "
+                "WHERE namespace = ? AND collection_id = ?",
+                (size_bytes, namespace, collection_id),
+            )
+
+    def record_query(self, namespace: str, collection_id: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE collections SET last_queried_at = ? "
+                "WHERE namespace = ? AND collection_id = ?",
+                (time.time(), namespace, collection_id),
+            )
+
+    def remove(self, namespace: str, collection_id: str) -> bool:
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "DELETE FROM collections "
+                "WHERE namespace = ? AND collection_id = ?",
+                (namespace, collection_id),
+            )
+        return cursor.rowcount > 0
+
+    def get(self, namespace: str, collection_id: str) -> dict[str, Any] | None:
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM collections "
+                "WHERE namespace = ? AND collection_id = ?",
+                (namespace, collection_id),
+            ).fetchone()
+        return dict(row) if row else None
+
+    def exists(self, namespace: str, collection_id: str) -> bool:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM collections "
+                "WHERE namespace = ? AND collection_id = ?",
+                (namespace, collection_id),
+            ).fetchone()
+        return row is not None
+
+    def ids(self, namespace: str) -> list[str]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT collection_id FROM collections WHERE namespace = ? "
+                "ORDER BY collection_id",
+                (namespace,),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def list(
+        self,
+        namespace: str,
+        offset: int = 0,
+        limit: int = None,
+    ) -> list[dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM collections "
+                "WHERE namespace = ? ORDER BY collection_id "
+                "LIMIT ? OFFSET ?",
+                (namespace, -1 if limit is None else limit, offset),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def stats(self, namespace: str) -> dict[str, Any]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*), SUM(documents), SUM(chunks), "
+                "SUM(size_bytes), SUM(build_seconds) "
+                "FROM collections WHERE namespace = ?",
+                (namespace,),
+            ).fetchone()
+        return {
+            "collections": row[0],
+            "documents": row[1] or 0,
+            "chunks": row[2] or 0,
+            "size_bytes": row[3] or 0,
+            "build_seconds": round(row[4] or 0.0, 3),
+        }
+
+    def backfill(
+        self,
+        namespace: str,
+        persist_dir: str | Path,
+        describe: DescribeFunc = None,
+    ) -> int:
+        """Register collections stored before the registry existed
+
+        Runs once per namespace, later calls do nothing.
+
+        Args:
+            namespace (str): namespace of the collections
+            persist_dir (str | Path): directory holding one directory per
+            collection
+
+            describe (DescribeFunc, optional): returns `register` keyword
+            arguments for a collection directory. Defaults to None.
+
+        Returns:
+            int: number of collections registered
+        """
+        with self._lock:
+            done = self._conn.execute(
+                "SELECT 1 FROM backfills WHERE namespace = ?",
+                (namespace,),
+            ).fetchone()
+        if done:
+            return 0
+
+        persist_dir = Path(persist_dir)
+        paths = [p for p in persist_dir.glob("*") if p.is_dir()]
+        for path in paths:
+            if self.exists(namespace, path.name):
+                continue
+            info = describe(path) if describe else {}
+            self.register(namespace, path.name, **info)
+
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO backfills VALUES (?, ?)",
+                (namespace, time.time()),
+            )
+        logger.info(
+            "Collection registry backfilled %d %s collections"
+            % (len(paths), namespace)
+        )
+        return len(paths)
+
+
+def dir_size(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+
+@lru_cache(maxsize=None)
+def get_collection_registry() -> CollectionRegistry:
+    return CollectionRegistry(config.llm.registry.path)
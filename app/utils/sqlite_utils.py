@@ -0,0 +1,20 @@
+from typing import Any, Iterable, Iterator
+
+# stay below SQLite's limit of host parameters per statement
+MAX_PARAMETERS = 500
+
+
+def in_batches(values: Iterable[Any]) -> Iterator[tuple[list[Any], str]]:
+    """Split values bound to an `IN (...)` clause into batches
+
+    Args:
+        values (Iterable[Any]): values to bind
+
+    Returns:
+        Iterator[tuple[list[Any], str]]: batches of at most
+        `MAX_PARAMETERS` values, with their placeholders
+    """
+    values = list(values)
+    for i in range(0, len(values), MAX_PARAMETERS):
+        batch = values[i : i + MAX_PARAMETERS]
+        yield batch, ",".join("?" * len(batch))
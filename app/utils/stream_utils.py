@@ -0,0 +1,136 @@
+import asyncio
+import json
+from queue import Full, Queue
+from typing import Any, AsyncIterator, Iterator
+
+from langchain.callbacks.base import BaseCallbackHandler
+from utils.logger_utils import get_logger
+
+logger = get_logger()
+
+
+def format_sse(data: Any, event: str = None) -> str:
+    """Format a server-sent event, data is sent as JSON
+
+    Args:
+        data (Any): JSON serializable payload
+        event (str, optional): event name. Defaults to None.
+
+    Returns:
+        str: the event, ready to be written to the response
+    """
+    message = "data: %s\n\n" % json.dumps(data)
+    if event:
+        message = "event: %s\n" % event + message
+    return message
+
+
+class QueueCallbackHandler(BaseCallbackHandler):
+    """Forward LLM tokens to a queue as they are generated"""
+
+    def __init__(self, queue: Queue) -> None:
+        self.queue = queue
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.queue.put(token)
+
+
+def iter_sse(events: Iterator[tuple[str, Any]]) -> Iterator[str]:
+    """Format (event, data) pairs as server-sent events
+
+    An exception raised by `events` is sent as a final `error` event, the
+    response status has already been sent at that point.
+    """
+    try:
+        for event, data in events:
+            yield format_sse(data, event=event)
+    except Exception as err:
+        logger.exception(err)
+        yield format_sse({"message": str(err)}, event="error")
+
+
+async def aiter_sse(
+    events: AsyncIterator[tuple[str, Any]]
+) -> AsyncIterator[str]:
+    """Async `iter_sse`
+
+    If the client disconnects, the response stops iterating `events` and
+    closes it, cancelling the work behind it.
+    """
+    try:
+        async for event, data in events:
+            yield format_sse(data, event=event)
+    except Exception as err:
+        logger.exception(err)
+        yield format_sse({"message": str(err)}, event="error")
+    finally:
+        await events.aclose()
+
+
+async def iter_lines(
+    chunks: AsyncIterator[bytes],
+) -> AsyncIterator[list[bytes]]:
+    """Split a byte stream into lines as it arrives
+
+    Yields:
+        list[bytes]: complete lines of each received chunk, without their
+        line breaks
+    """
+    rest = b""
+    async for chunk in chunks:
+        *lines, rest = (rest + chunk).split(b"\n")
+        if lines:
+            yield lines
+    if rest:
+        yield [rest]
+
+
+_QUEUE_END = object()
+
+
+async def _put(queue: Queue, item: Any, consumer: asyncio.Future) -> bool:
+    # a full queue must not block the event loop, nor wait on a consumer
+    # that is gone
+    delay = 0.001
+    while not consumer.done():
+        try:
+            queue.put_nowait(item)
+            return True
+        except Full:
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.05)
+    return False
+
+
+async def feed_queue(
+    batches: AsyncIterator[list[Any]],
+    queue: Queue,
+    consumer: asyncio.Future,
+) -> None:
+    """Put batches on a bounded queue read by `iter_queue` in a thread
+
+    The queue bounds the memory held between a fast producer and a slow
+    consumer. An exception of `batches` is passed to the consumer, and
+    feeding stops early if the consumer finished.
+
+    Args:
+        batches (AsyncIterator[list[Any]]): items, in batches
+        queue (Queue): bounded queue
+        consumer (asyncio.Future): the task running `iter_queue`
+    """
+    try:
+        async for batch in batches:
+            if not await _put(queue, batch, consumer):
+                return
+    except Exception as err:
+        await _put(queue, err, consumer)
+        return
+    await _put(queue, _QUEUE_END, consumer)
+
+
+def iter_queue(queue: Queue) -> Iterator[Any]:
+    """Items fed by `feed_queue`, raising the exception of the producer"""
+    while (batch := queue.get()) is not _QUEUE_END:
+        if isinstance(batch, Exception):
+            raise batch
+        yield from batch
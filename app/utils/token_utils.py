@@ -0,0 +1,76 @@
+import time
+from functools import lru_cache
+
+import tiktoken
+from utils.config_utils import get_config
+from utils.logger_utils import get_logger
+
+config = get_config()
+
+logger = get_logger()
+
+
+# a failed load is retried at most once per interval, loading from the
+# network while offline can take a while to fail
+_RETRY_SECONDS = 60.0
+
+_failed_at: dict[str, float] = {}
+
+
+@lru_cache(maxsize=None)
+def _load_encoding(model_name: str) -> tiktoken.Encoding:
+    # raises on failure, only successful loads are cached
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def get_encoding(model_name: str = None) -> tiktoken.Encoding | None:
+    """tiktoken encoding of a model, loaded once per model
+
+    Args:
+        model_name (str, optional): model name.
+        Defaults to config.llm.model_name.
+
+    Returns:
+        tiktoken.Encoding | None: encoding, cl100k_base for unknown models.
+        None if it can't be loaded, e.g. offline without TIKTOKEN_CACHE_DIR
+    """
+    model_name = model_name or config.llm.model_name
+    failed_at = _failed_at.get(model_name)
+    if failed_at is not None and time.monotonic() - failed_at < _RETRY_SECONDS:
+        return None
+
+    try:
+        encoding = _load_encoding(model_name)
+    except Exception as err:
+        _failed_at[model_name] = time.monotonic()
+        logger.warning(
+            "tiktoken encoding unavailable, estimating token counts: %s" % err
+        )
+        return None
+
+    _failed_at.pop(model_name, None)
+    return encoding
+
+
+def count_tokens(text: str, model_name: str = None) -> int:
+    encoding = get_encoding(model_name or config.llm.model_name)
+    if encoding is None:
+        # ~4 characters per token for english text
+        return -(-len(text) // 4)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(
+    messages: list[dict[str, str]],
+    model_name: str = None,
+) -> int:
+    """Prompt tokens of chat messages, as billed by the chat API"""
+    # every message is wrapped in 3 formatting tokens and the reply is
+    # primed with 3 more
+    return 3 + sum(
+        3 + sum(count_tokens(value, model_name) for value in message.values())
+        for message in messages
+    )
@@ -0,0 +1,938 @@
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from abc import abstractmethod
+from pathlib import Path
+from typing import Any, Iterable
+
+import faiss
+import numpy as np
+from langchain.embeddings.base import Embeddings
+from langchain.schema import Document
+from langchain.vectorstores import Chroma
+from langchain.vectorstores.base import VectorStore
+from langchain.vectorstores.utils import maximal_marginal_relevance
+from utils.logger_utils import get_logger
+from utils.sqlite_utils import in_batches
+
+logger = get_logger()
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.clip(norms, 1e-12, None)
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indexes of the k highest scores, best first"""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    idxs = np.argpartition(-scores, k - 1)[:k]
+    return idxs[np.argsort(-scores[idxs])]
+
+
+QUANTIZATIONS = ("none", "float16", "int8")
+
+
+def quantize(
+    vectors: np.ndarray,
+    quantization: str,
+) -> tuple[np.ndarray, np.ndarray | None]:
+    """Compact codes of float32 rows
+
+    float16 halves the bytes. int8 quarters them: every row is scaled by
+    its largest absolute value to [-127, 127], the scale is kept with it.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray | None]: codes and the per-row scales
+        to multiply them back by, None for float16
+    """
+    if quantization == "float16":
+        return vectors.astype(np.float16), None
+    if quantization != "int8":
+        raise ValueError("Unknown quantization: %s" % quantization)
+
+    scales = np.clip(np.abs(vectors).max(axis=-1), 1e-12, None) / 127
+    codes = np.rint(vectors / scales[..., None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def dequantize(codes: np.ndarray, scales: np.ndarray = None) -> np.ndarray:
+    vectors = np.array(codes, dtype=np.float32)
+    if scales is not None:
+        vectors *= np.asarray(scales, dtype=np.float32)[..., None]
+    return vectors
+
+
+def quantized_scores(
+    codes: np.ndarray,
+    scales: np.ndarray,
+    query: np.ndarray,
+    block: int = 16384,
+) -> np.ndarray:
+    """Inner products of a query with quantized rows
+
+    Rows are widened to float32 a block at a time, so the scan stays one
+    matrix product per block without materializing the whole matrix.
+    """
+    scores = np.empty(len(codes), dtype=np.float32)
+    for start in range(0, len(codes), block):
+        rows = np.asarray(codes[start : start + block], dtype=np.float32)
+        scores[start : start + block] = rows @ query
+    if scales is not None:
+        scores *= scales
+    return scores
+
+
+def measure_recall(
+    vectors: np.ndarray,
+    codes: np.ndarray,
+    scales: np.ndarray = None,
+    k: int = 10,
+    rerank_factor: int = 4,
+    queries: int = 50,
+    sample: int = 20000,
+) -> dict[str, Any]:
+    """Recall of quantized search against exact float32 search
+
+    Stored rows are used as queries, each left out of its own results, over
+    a random sample of the collection.
+
+    Returns:
+        dict[str, Any]: recall@k of the quantized scores alone and after
+        re-ranking `k * rerank_factor` candidates at full precision, with
+        the bytes of both representations
+    """
+    rng = np.random.default_rng(0)
+    rows = np.sort(rng.permutation(len(vectors))[:sample])
+    corpus = np.asarray(vectors[rows], dtype=np.float32)
+    corpus_codes = codes[rows]
+    corpus_scales = None if scales is None else scales[rows]
+
+    k = min(k, len(rows) - 1)
+    hits, reranked_hits = 0, 0
+    picked = rng.permutation(len(rows))[:queries] if k > 0 else []
+    for i in picked:
+        exact = corpus @ corpus[i]
+        exact[i] = -np.inf
+        approx = quantized_scores(corpus_codes, corpus_scales, corpus[i])
+        approx[i] = -np.inf
+
+        expected = set(top_k(exact, k).tolist())
+        hits += len(expected & set(top_k(approx, k).tolist()))
+        candidates = top_k(approx, k * rerank_factor)
+        reranked = candidates[top_k(exact[candidates], k)]
+        reranked_hits += len(expected & set(reranked.tolist()))
+
+    total = k * len(picked)
+    return {
+        "k": k,
+        "queries": len(picked),
+        "sample": len(rows),
+        "recall": round(hits / total, 4) if total else None,
+        "recall_reranked": round(reranked_hits / total, 4) if total else None,
+        "float32_bytes": int(vectors.nbytes),
+        "quantized_bytes": int(
+            codes.nbytes + (0 if scales is None else scales.nbytes)
+        ),
+    }
+
+
+class EmbeddingVectorStore(VectorStore):
+    """Vectorstore searched through `query_with_embeddings`
+
+    Subclasses store L2-normalized embeddings and implement
+    `add_embeddings` and `query_with_embeddings`, the text and vector
+    searches, with scores and MMR, are derived from them.
+    """
+
+    _embedding_function: Embeddings
+
+    @abstractmethod
+    def add_embeddings(
+        self,
+        docs: list[Document],
+        embeddings: list[list[float]],
+        ids: list[str] = None,
+    ) -> list[str]:
+        """Add documents with their embeddings, returns their ids"""
+
+    @abstractmethod
+    def query_with_embeddings(
+        self,
+        embedding: list[float],
+        n: int,
+    ) -> tuple[list[Document], np.ndarray, np.ndarray]:
+        """Nearest documents of an embedding
+
+        Returns:
+            tuple[list[Document], np.ndarray, np.ndarray]: documents, their
+            embeddings and cosine similarity scores, best first
+        """
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: list[dict] = None,
+        **kwargs: Any,
+    ) -> list[str]:
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        docs = [
+            Document(page_content=text, metadata=metadata)
+            for text, metadata in zip(texts, metadatas)
+        ]
+        embeddings = self._embedding_function.embed_documents(texts)
+        return self.add_embeddings(docs, embeddings, ids=kwargs.get("ids"))
+
+    def similarity_search_by_vector_with_score(
+        self,
+        embedding: list[float],
+        k: int = 4,
+    ) -> list[tuple[Document, float]]:
+        docs, _, scores = self.query_with_embeddings(embedding, k)
+        return [(doc, float(score)) for doc, score in zip(docs, scores)]
+
+    def similarity_search_with_score(
+        self,
+        query: str,
+        k: int = 4,
+        **kwargs: Any,
+    ) -> list[tuple[Document, float]]:
+        embedding = self._embedding_function.embed_query(query)
+        return self.similarity_search_by_vector_with_score(embedding, k)
+
+    def _similarity_search_with_relevance_scores(
+        self,
+        query: str,
+        k: int = 4,
+        **kwargs: Any,
+    ) -> list[tuple[Document, float]]:
+        # map cosine similarity from [-1, 1] to [0, 1]
+        return [
+            (doc, (score + 1) / 2)
+            for doc, score in self.similarity_search_with_score(query, k)
+        ]
+
+    def similarity_search_by_vector(
+        self,
+        embedding: list[float],
+        k: int = 4,
+        **kwargs: Any,
+    ) -> list[Document]:
+        docs, _, _ = self.query_with_embeddings(embedding, k)
+        return docs
+
+    def similarity_search(
+        self,
+        query: str,
+        k: int = 4,
+        **kwargs: Any,
+    ) -> list[Document]:
+        embedding = self._embedding_function.embed_query(query)
+        return self.similarity_search_by_vector(embedding, k)
+
+    def max_marginal_relevance_search_by_vector(
+        self,
+        embedding: list[float],
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        **kwargs: Any,
+    ) -> list[Document]:
+        docs, vectors, _ = self.query_with_embeddings(embedding, fetch_k)
+        idxs = maximal_marginal_relevance(
+            np.asarray(embedding, dtype=np.float32),
+            vectors,
+            lambda_mult=lambda_mult,
+            k=k,
+        )
+        return [docs[i] for i in idxs]
+
+    def max_marginal_relevance_search(
+        self,
+        query: str,
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        **kwargs: Any,
+    ) -> list[Document]:
+        embedding = self._embedding_function.embed_query(query)
+        return self.max_marginal_relevance_search_by_vector(
+            embedding, k=k, fetch_k=fetch_k, lambda_mult=lambda_mult
+        )
+
+
+class NumpyVectorStore(EmbeddingVectorStore):
+    """In-memory vectorstore backed by a contiguous NumPy matrix
+
+    Embeddings are L2-normalized and kept in a single float32 matrix, so a
+    query is one matrix-vector product followed by a partial sort. Nothing
+    is written to disk, which makes it a good fit for throwaway document
+    sets.
+
+    Args:
+        embedding_function (Embeddings): embeddings used for texts and
+        queries
+    """
+
+    def __init__(self, embedding_function: Embeddings) -> None:
+        self._embedding_function = embedding_function
+        self._vectors: np.ndarray | None = None
+        self._size = 0
+        self._docs: list[Document] = []
+        self._ids: list[str] = []
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def vectors(self) -> np.ndarray:
+        if self._vectors is None:
+            return np.empty((0, 0), dtype=np.float32)
+        return self._vectors[: self._size]
+
+    def add_embeddings(
+        self,
+        docs: list[Document],
+        embeddings: list[list[float]],
+        ids: list[str] = None,
+    ) -> list[str]:
+        if not docs:
+            return []
+
+        vectors = normalize(np.asarray(embeddings, dtype=np.float32))
+        needed = self._size + len(vectors)
+        if self._vectors is None:
+            self._vectors = np.empty(
+                (needed, vectors.shape[1]), dtype=np.float32
+            )
+        elif needed > len(self._vectors):
+            # grow geometrically so repeated adds stay amortized O(1)
+            grown = np.empty(
+                (max(needed, 2 * len(self._vectors)), vectors.shape[1]),
+                dtype=np.float32,
+            )
+            grown[: self._size] = self._vectors[: self._size]
+            self._vectors = grown
+
+        self._vectors[self._size : needed] = vectors
+        self._size = needed
+
+        ids = ids or [str(uuid.uuid4()) for _ in docs]
+        self._docs.extend(docs)
+        self._ids.extend(ids)
+        return ids
+
+    def query_with_embeddings(
+        self,
+        embedding: list[float],
+        n: int,
+    ) -> tuple[list[Document], np.ndarray, np.ndarray]:
+        query = normalize(np.asarray(embedding, dtype=np.float32))
+        vectors = self.vectors
+        if not len(vectors):
+            return [], vectors, np.empty(0, dtype=np.float32)
+
+        scores = vectors @ query
+        idxs = top_k(scores, n)
+        return [self._docs[i] for i in idxs], vectors[idxs], scores[idxs]
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: list[str],
+        embedding: Embeddings,
+        metadatas: list[dict] = None,
+        **kwargs: Any,
+    ) -> "NumpyVectorStore":
+        store = cls(embedding)
+        store.add_texts(texts, metadatas=metadatas, **kwargs)
+        return store
+
+
+class FaissVectorStore(EmbeddingVectorStore):
+    """Persisted vectorstore with memory-mapped vectors and a FAISS search
+
+    A collection directory holds the L2-normalized embeddings as a float32
+    `.npy` matrix, opened with `np.load(mmap_mode="r")`, and its chunks in
+    a SQLite docstore keyed by row. Opening a collection reads neither, so
+    it is near-instant whatever the size, and processes serving the same
+    collection share its pages through the OS page cache.
+
+    With the "flat" index type queries are exact FAISS inner product
+    searches over the mapped matrix. The "hnsw" index type also persists a
+    FAISS HNSW graph for approximate search of large collections; the
+    graph is loaded in memory, only its vectors are mapped when the FAISS
+    build supports it.
+
+    Flat collections may store their vectors quantized, as float16 or as
+    int8 with a per-row scale, for half or a quarter of the bytes. Queries
+    score the mapped codes and, with `rerank`, rescore the best
+    `n * rerank_factor` candidates from the float32 matrix, which is then
+    kept on disk but only read for those rows. Each persist measures the
+    recall loss, see `read_quantization_report`.
+
+    The index type, quantization and rerank of a collection are fixed when
+    it is first persisted, later arguments don't change them.
+
+    Rows added since the last `persist` are kept in memory. Deleted rows
+    are dropped from the docstore at once and from the files on the next
+    `persist`.
+
+    Args:
+        embedding_function (Embeddings): embeddings used for texts and
+        queries
+
+        persist_directory (str | Path): directory of the collection
+        index_type (str, optional): "flat" or "hnsw". Defaults to "flat".
+        hnsw_m (int, optional): neighbors per HNSW node. Defaults to 32.
+        ef_search (int, optional): HNSW search depth, raised to the number
+        of requested results if lower. Defaults to 64.
+
+        quantization (str, optional): "none", "float16" or "int8", flat
+        index type only. Defaults to "none".
+
+        rerank (bool, optional): rescore quantized candidates at full
+        precision. Defaults to True.
+
+        rerank_factor (int, optional): candidates rescored per requested
+        result. Defaults to 4.
+    """
+
+    VECTORS_FILE = "vectors.npy"
+    CODES_FILE = "codes.npy"
+    SCALES_FILE = "scales.npy"
+    INDEX_FILE = "index.faiss"
+    DOCSTORE_FILE = "docstore.sqlite3"
+    SETTINGS_FILE = "store.json"
+    REPORT_FILE = "quantization.json"
+
+    def __init__(
+        self,
+        embedding_function: Embeddings,
+        persist_directory: str | Path,
+        index_type: str = "flat",
+        hnsw_m: int = 32,
+        ef_search: int = 64,
+        quantization: str = "none",
+        rerank: bool = True,
+        rerank_factor: int = 4,
+    ) -> None:
+        self._embedding_function = embedding_function
+        self.persist_directory = Path(persist_directory)
+        self.persist_directory.mkdir(parents=True, exist_ok=True)
+
+        settings_path = self.persist_directory / self.SETTINGS_FILE
+        if settings_path.exists():
+            settings = json.loads(settings_path.read_text())
+            index_type = settings["index_type"]
+            quantization = settings["quantization"]
+            rerank = settings["rerank"]
+        elif (self.persist_directory / self.VECTORS_FILE).exists():
+            # persisted before quantization existed
+            quantization = "none"
+
+        if index_type not in ("flat", "hnsw"):
+            raise ValueError("Unknown index type: %s" % index_type)
+        if quantization not in QUANTIZATIONS:
+            raise ValueError("Unknown quantization: %s" % quantization)
+        if quantization != "none" and index_type != "flat":
+            raise ValueError("Quantization requires the flat index type")
+
+        self.index_type = index_type
+        self.hnsw_m = hnsw_m
+        self.ef_search = ef_search
+        self.quantization = quantization
+        self.rerank = rerank
+        self.rerank_factor = rerank_factor
+
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(
+            str(self.persist_directory / self.DOCSTORE_FILE),
+            check_same_thread=False,
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS chunks (
+                row INTEGER PRIMARY KEY,
+                id TEXT NOT NULL UNIQUE,
+                text TEXT NOT NULL,
+                metadata TEXT NOT NULL
+            )
+            """
+        )
+
+        self._base: np.ndarray | None = None  # persisted rows, mapped
+        self._codes: np.ndarray | None = None  # quantized persisted rows
+        self._scales: np.ndarray | None = None
+        self._pending: np.ndarray | None = None  # rows added since
+        self._index = None  # HNSW graph over all rows
+        self._index_writable = False
+        self._deleted = 0
+
+        self._load()
+
+        index_path = self.persist_directory / self.INDEX_FILE
+        if self.index_type == "hnsw" and index_path.exists():
+            self._index = faiss.read_index(
+                str(index_path),
+                faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY,
+            )
+
+        if self._index is not None and self._index.ntotal != self._persisted:
+            # interrupted persist, the vectors file is the reference
+            logger.warning(
+                "Rebuilding HNSW index of %s" % str(self.persist_directory)
+            )
+            self._index = None
+            if self._base is not None:
+                self._index = self._new_index(self._base.shape[1])
+                self._index.add(np.ascontiguousarray(self._base))
+
+        with self._conn:
+            # rows whose vectors were never persisted are lost
+            self._conn.execute(
+                "DELETE FROM chunks WHERE row >= ?", (self._persisted,)
+            )
+        self._deleted = self._persisted - len(self)
+
+    def _load(self) -> None:
+        """Map the persisted vector files"""
+        self._base = self._codes = self._scales = None
+        if self.quantization == "none" or self.rerank:
+            self._base = self._map(self.VECTORS_FILE)
+        if self.quantization != "none":
+            self._codes = self._map(self.CODES_FILE)
+            self._scales = self._map(self.SCALES_FILE)
+
+    def _map(self, name: str) -> np.ndarray | None:
+        path = self.persist_directory / name
+        return np.load(path, mmap_mode="r") if path.exists() else None
+
+    def _save(self, name: str, array: np.ndarray) -> None:
+        # write then rename, readers of the old files keep their pages
+        path = self.persist_directory / name
+        tmp_path = path.with_suffix(".tmp.npy")
+        np.save(tmp_path, np.ascontiguousarray(array))
+        os.replace(tmp_path, path)
+
+    @property
+    def _persisted(self) -> int:
+        if self._codes is not None:
+            return len(self._codes)
+        return 0 if self._base is None else len(self._base)
+
+    @property
+    def _rows(self) -> int:
+        pending = 0 if self._pending is None else len(self._pending)
+        return self._persisted + pending
+
+    def __len__(self) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()
+        return row[0]
+
+    def _persisted_vectors(self, rows: np.ndarray | slice) -> np.ndarray:
+        if self._base is not None:
+            return np.asarray(self._base[rows], dtype=np.float32)
+        return dequantize(
+            self._codes[rows],
+            None if self._scales is None else self._scales[rows],
+        )
+
+    @property
+    def _dimension(self) -> int:
+        for vectors in (self._base, self._codes, self._pending):
+            if vectors is not None:
+                return vectors.shape[1]
+        return 0
+
+    def _vectors(self, rows: np.ndarray) -> np.ndarray:
+        rows = np.asarray(rows, dtype=np.int64)
+        if not len(rows):
+            return np.empty((0, 0), dtype=np.float32)
+
+        vectors = np.empty((len(rows), self._dimension), dtype=np.float32)
+        persisted = rows < self._persisted
+        if persisted.any():
+            vectors[persisted] = self._persisted_vectors(rows[persisted])
+        if not persisted.all():
+            pending = rows[~persisted] - self._persisted
+            vectors[~persisted] = self._pending[pending]
+        return vectors
+
+    def memory_usage(self) -> int:
+        """Approximate bytes of the collection in memory
+
+        Counts the vectors scanned by queries, mapped or not, the rows
+        added since the last persist and the SQLite page cache of the
+        docstore. The float32 rows only read to re-rank quantized
+        candidates are left out.
+        """
+        with self._lock:
+            nbytes = 0
+            if self.index_type == "hnsw":
+                if self._index is not None:
+                    # vectors and base layer links, upper layers are small
+                    nbytes = self._index.ntotal * (
+                        4 * self._index.d + 8 * self.hnsw_m
+                    )
+            elif self._codes is not None:
+                nbytes = self._codes.nbytes
+                if self._scales is not None:
+                    nbytes += self._scales.nbytes
+            elif self._base is not None:
+                nbytes = self._base.nbytes
+            if self._pending is not None:
+                nbytes += self._pending.nbytes
+
+            page_size, pages, cache_size = (
+                self._conn.execute("PRAGMA %s" % pragma).fetchone()[0]
+                for pragma in ("page_size", "page_count", "cache_size")
+            )
+        # a negative cache size is in KiB
+        cache = (
+            -cache_size * 1024 if cache_size < 0 else cache_size * page_size
+        )
+        return nbytes + min(pages * page_size, cache)
+
+    def _new_index(self, dimension: int) -> Any:
+        index = faiss.IndexHNSWFlat(
+            dimension, self.hnsw_m, faiss.METRIC_INNER_PRODUCT
+        )
+        self._index_writable = True
+        return index
+
+    def add_embeddings(
+        self,
+        docs: list[Document],
+        embeddings: list[list[float]],
+        ids: list[str] = None,
+    ) -> list[str]:
+        if not docs:
+            return []
+
+        vectors = normalize(np.asarray(embeddings, dtype=np.float32))
+        ids = ids or [str(uuid.uuid4()) for _ in docs]
+
+        with self._lock:
+            start = self._rows
+            self._pending = (
+                vectors
+                if self._pending is None
+                else np.concatenate([self._pending, vectors])
+            )
+
+            if self.index_type == "hnsw":
+                if self._index is None:
+                    self._index = self._new_index(vectors.shape[1])
+                elif not self._index_writable:
+                    # the mapped graph is read-only, load a private copy
+                    self._index = faiss.read_index(
+                        str(self.persist_directory / self.INDEX_FILE)
+                    )
+                    self._index_writable = True
+                self._index.add(vectors)
+
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT INTO chunks (row, id, text, metadata) "
+                    "VALUES (?, ?, ?, ?)",
+                    [
+                        (
+                            start + i,
+                            chunk_id,
+                            doc.page_content,
+                            json.dumps(doc.metadata),
+                        )
+                        for i, (chunk_id, doc) in enumerate(zip(ids, docs))
+                    ],
+                )
+        return ids
+
+    def delete(self, ids: list[str]) -> int:
+        """Delete chunks by id
+
+        Returns:
+            int: number of deleted chunks
+        """
+        with self._lock, self._conn:
+            deleted = 0
+            for batch, placeholders in in_batches(ids):
+                cursor = self._conn.execute(
+                    f"DELETE FROM chunks WHERE id IN ({placeholders})",
+                    batch,
+                )
+                deleted += cursor.rowcount
+            self._deleted += deleted
+        return deleted
+
+    def get(
+        self,
+        include: list[str] = None,
+        ids: list[str] = None,
+    ) -> dict[str, list]:
+        """Stored chunks, all or by id, in the format of `Chroma.get`"""
+        include = include or ["documents", "metadatas"]
+        with self._lock:
+            if ids is None:
+                rows = self._conn.execute(
+                    "SELECT id, text, metadata FROM chunks ORDER BY row"
+                ).fetchall()
+            else:
+                rows = []
+                for batch, placeholders in in_batches(ids):
+                    rows.extend(
+                        self._conn.execute(
+                            "SELECT id, text, metadata FROM chunks "
+                            f"WHERE id IN ({placeholders}) ORDER BY row",
+                            batch,
+                        )
+                    )
+
+        result = {"ids": [row[0] for row in rows]}
+        if "documents" in include:
+            result["documents"] = [row[1] for row in rows]
+        if "metadatas" in include:
+            result["metadatas"] = [json.loads(row[2]) for row in rows]
+        return result
+
+    def _search(self, query: np.ndarray, n: int) -> tuple[list, list]:
+        if self.index_type == "hnsw":
+            self._index.hnsw.efSearch = max(self.ef_search, n)
+            scores, rows = self._index.search(query[None], n)
+            return scores[0].tolist(), rows[0].tolist()
+
+        scores, rows = [], []
+        if self._codes is not None and len(self._codes):
+            scores, rows = self._search_quantized(query, n)
+        elif self._base is not None and len(self._base):
+            d, i = faiss.knn(
+                query[None],
+                self._base,
+                min(n, len(self._base)),
+                metric=faiss.METRIC_INNER_PRODUCT,
+            )
+            scores, rows = d[0].tolist(), i[0].tolist()
+        if self._pending is not None:
+            pending_scores = self._pending @ query
+            for i in top_k(pending_scores, n):
+                scores.append(float(pending_scores[i]))
+                rows.append(self._persisted + int(i))
+
+        order = np.argsort(-np.asarray(scores, dtype=np.float32))[:n]
+        return [scores[i] for i in order], [rows[i] for i in order]
+
+    def _search_quantized(
+        self,
+        query: np.ndarray,
+        n: int,
+    ) -> tuple[list, list]:
+        scores = quantized_scores(self._codes, self._scales, query)
+        if self._base is None:
+            rows = top_k(scores, n)
+            return scores[rows].tolist(), rows.tolist()
+
+        # sorted rows read the mapped float32 matrix front to back
+        candidates = np.sort(top_k(scores, n * self.rerank_factor))
+        exact = self._base[candidates] @ query
+        best = top_k(exact, n)
+        return exact[best].tolist(), candidates[best].tolist()
+
+    def query_with_embeddings(
+        self,
+        embedding: list[float],
+        n: int,
+    ) -> tuple[list[Document], np.ndarray, np.ndarray]:
+        query = normalize(np.asarray(embedding, dtype=np.float32))
+        with self._lock:
+            if not self._rows:
+                return (
+                    [],
+                    np.empty((0, len(query)), dtype=np.float32),
+                    np.empty(0, dtype=np.float32),
+                )
+
+            # deleted rows are still searched, fetch enough to skip them
+            scores, rows = self._search(
+                query, min(n + self._deleted, self._rows)
+            )
+            hits = [(s, r) for s, r in zip(scores, rows) if r >= 0]
+            found = {}
+            for batch, placeholders in in_batches(r for _, r in hits):
+                found.update(
+                    (row, (text, metadata))
+                    for row, text, metadata in self._conn.execute(
+                        "SELECT row, text, metadata FROM chunks "
+                        f"WHERE row IN ({placeholders})",
+                        batch,
+                    )
+                )
+
+            hits = [(s, r) for s, r in hits if r in found][:n]
+            docs = [
+                Document(
+                    page_content=found[r][0],
+                    metadata=json.loads(found[r][1]),
+                )
+                for _, r in hits
+            ]
+            vectors = self._vectors(np.array([r for _, r in hits]))
+            scores = np.array([s for s, _ in hits], dtype=np.float32)
+        return docs, vectors, scores
+
+    def _compact(self) -> np.ndarray:
+        """Drop deleted rows, renumbering the remaining ones"""
+        rows = [
+            row
+            for row, in self._conn.execute(
+                "SELECT row FROM chunks ORDER BY row"
+            )
+        ]
+        vectors = self._vectors(np.array(rows, dtype=np.int64))
+        with self._conn:
+            # rows only move down, in order, so no two ever collide
+            self._conn.executemany(
+                "UPDATE chunks SET row = ? WHERE row = ?",
+                [(new, old) for new, old in enumerate(rows) if new != old],
+            )
+        if self.index_type == "hnsw":
+            self._index = self._new_index(vectors.shape[1])
+            if len(vectors):
+                self._index.add(vectors)
+        self._deleted = 0
+        return vectors
+
+    def persist(self) -> None:
+        with self._lock:
+            if self._deleted:
+                vectors = self._compact()
+            elif self._pending is None:
+                return
+            elif not self._persisted:
+                vectors = self._pending
+            else:
+                vectors = np.concatenate(
+                    [self._persisted_vectors(slice(None)), self._pending]
+                )
+            vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+
+            if self.quantization != "none":
+                codes, scales = quantize(vectors, self.quantization)
+                self._save(self.CODES_FILE, codes)
+                if scales is not None:
+                    self._save(self.SCALES_FILE, scales)
+                report = measure_recall(
+                    vectors,
+                    codes,
+                    scales,
+                    rerank_factor=self.rerank_factor,
+                )
+                report.update(
+                    quantization=self.quantization,
+                    rerank=self.rerank,
+                )
+                (self.persist_directory / self.REPORT_FILE).write_text(
+                    json.dumps(report)
+                )
+            if self.quantization == "none" or self.rerank:
+                self._save(self.VECTORS_FILE, vectors)
+
+            if self.index_type == "hnsw" and self._index is not None:
+                index_path = self.persist_directory / self.INDEX_FILE
+                tmp_path = index_path.with_suffix(".tmp")
+                faiss.write_index(self._index, str(tmp_path))
+                os.replace(tmp_path, index_path)
+
+            (self.persist_directory / self.SETTINGS_FILE).write_text(
+                json.dumps(
+                    {
+                        "index_type": self.index_type,
+                        "quantization": self.quantization,
+                        "rerank": self.rerank,
+                    }
+                )
+            )
+            self._load()
+            self._pending = None
+
+    @classmethod
+    def read_quantization_report(
+        cls,
+        persist_directory: str | Path,
+    ) -> dict[str, Any] | None:
+        """Recall and size of the quantized vectors at the last persist,
+        see `measure_recall`. None if the collection isn't quantized"""
+        path = Path(persist_directory) / cls.REPORT_FILE
+        return json.loads(path.read_text()) if path.exists() else None
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: list[str],
+        embedding: Embeddings,
+        metadatas: list[dict] = None,
+        persist_directory: str | Path = None,
+        **kwargs: Any,
+    ) -> "FaissVectorStore":
+        store = cls(embedding, persist_directory, **kwargs)
+        store.add_texts(texts, metadatas=metadatas)
+        store.persist()
+        return store
+
+
+class ThreadSafeChroma(Chroma):
+    """Chroma collection that can be queried from several threads
+
+    The duckdb connection of a chromadb client fails when several threads
+    query it at once, so reads of a collection run one at a time under
+    `query_lock`. Writes must be serialized by the caller.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.query_lock = threading.Lock()
+
+    # every search of Chroma goes through its private query helper
+    def _Chroma__query_collection(self, *args: Any, **kwargs: Any) -> Any:
+        with self.query_lock:
+            return super()._Chroma__query_collection(*args, **kwargs)
+
+    def memory_usage(self) -> int:
+        """Approximate bytes of the collection in memory
+
+        duckdb loads the persisted parquet files whole and hnswlib its
+        index files, their sizes on disk are close. Writes not persisted
+        yet are left out.
+        """
+        path = Path(self._persist_directory)
+        files = [*path.glob("*.parquet"), *path.glob("index/*")]
+        return sum(f.stat().st_size for f in files if f.is_file())
+
+    def release(self) -> None:
+        """Let the collection be garbage collected once unreferenced
+
+        chromadb registers every client to be persisted at exit, which
+        keeps it in memory for the life of the process. Pending writes are
+        not persisted at exit anymore.
+        """
+        atexit.unregister(self._client._db.persist)
+
+    def get(
+        self,
+        include: list[str] = None,
+        ids: list[str] = None,
+    ) -> dict[str, Any]:
+        with self.query_lock:
+            if ids is None:
+                return super().get(include=include)
+            return self._collection.get(
+                ids=ids,
+                include=include or ["documents", "metadatas"],
+            )